@@ -0,0 +1,103 @@
+import multiprocessing
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from src.instrumentation import request_context
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def _warm_worker():
+    from src.pipeline import warm_up
+    warm_up()
+
+
+def _on_alarm(signum, frame):
+    raise JobTimeout()
+
+
+def _run_job(fn, args, kwargs, timeout, context):
+    # Задачи пула выполняются в главном потоке процесса-воркера, поэтому
+    # таймаут можно поставить через SIGALRM и не убивать весь пул
+    use_alarm = timeout and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with request_context(**(context or {})) as ctx:
+            result = fn(*args, **kwargs)
+        # Замеры стадий из воркера возвращаются вместе с результатом
+        if isinstance(result, dict):
+            result['stages'] = ctx['records']
+        return result
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class AnalysisQueue:
+    def __init__(self, max_workers=2, max_pending=8, job_timeout=300):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.job_timeout = job_timeout
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = self._new_executor()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_worker,
+        )
+
+    def submit(self, fn, *args, on_done=None, context=None, **kwargs):
+        with self._lock:
+            executor, slots = self._executor, self._slots
+        try:
+            return self._submit(executor, slots, fn, args, kwargs, on_done, context)
+        except BrokenProcessPool:
+            # Воркер упал (segfault MediaPipe, OOM) — такой пул больше не
+            # принимает задачи, поэтому он пересоздаётся и задача ставится заново
+            executor, slots = self._restart(executor)
+            return self._submit(executor, slots, fn, args, kwargs, on_done, context)
+
+    def _submit(self, executor, slots, fn, args, kwargs, on_done, context):
+        # max_pending считает и ожидающие, и уже выполняющиеся задачи
+        if not slots.acquire(blocking=False):
+            raise QueueFull()
+        try:
+            future = executor.submit(_run_job, fn, args, kwargs, self.job_timeout, context)
+        except Exception:
+            slots.release()
+            raise
+        # Слот возвращается в тот семафор, из которого взят: после перезапуска
+        # пула задачи старого пула не должны освобождать слоты нового
+        future.add_done_callback(lambda _: slots.release())
+        if on_done is not None:
+            future.add_done_callback(on_done)
+        return future
+
+    def _restart(self, broken):
+        with self._lock:
+            # Другой поток мог уже пересоздать пул
+            if self._executor is broken:
+                print("[QUEUE] Пул воркеров сломан, перезапуск")
+                self._executor = self._new_executor()
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+            executor, slots = self._executor, self._slots
+        broken.shutdown(wait=False, cancel_futures=True)
+        return executor, slots
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor = self._executor
+        executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,158 @@
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+from src.blinks_analysis import analyze_ear_sequence, select_ear
+from src.calibration_store import open_calibration_store
+from src.ear_cache import EarCache, FeatureStore, file_digest
+from src.fatigue_calc import (FEATURES, WEIGHTS, calibration_outdated, feature_contributions, feature_matrix,
+                              fatigue_to_absolute_kss)
+from src.media_store import MediaStore
+from src.pipeline import run_branches, warm_up
+from src.streaming import VOICE_FEATURES
+
+VIDEO_DIR = Path.cwd() / "videos"
+RESULTS_DIR = Path.cwd() / "batch_results"
+
+
+def find_clips(video_dir):
+    # Клипы анализа: videos/<user_id>/<timestamp>.mp4 и ролики из индекса
+    # хранилища, MP4 которых уже удалён (для них известен только хэш).
+    # Калибровочные ролики и служебные каталоги (.ear_cache) пропускаются.
+    # Возвращает (user_id, путь, хэш или None).
+    clips = {}
+    for user_dir in Path(video_dir).iterdir():
+        if not user_dir.is_dir() or user_dir.name.startswith('.'):
+            continue
+        for clip in user_dir.glob("*.mp4"):
+            if not clip.name.startswith("calibration_"):
+                clips[clip] = (user_dir.name, clip, None)
+    for user_id, clip, digest in MediaStore(video_dir).clips():
+        if clip not in clips and not clip.name.startswith("calibration_") and not clip.exists():
+            clips[clip] = (user_id, clip, digest)
+    return sorted(clips.values(), key=lambda c: (c[0], str(c[1])))
+
+
+def extract_clip(video_path, digest, cache_root, features_root):
+    # Выполняется в процессе пула: EAR-ряд уходит в общий кэш, признаки
+    # ролика — в хранилище признаков, где их найдёт следующий прогон.
+    # Хэш уже посчитан в run(), повторно файл не хэшируется.
+    cache = EarCache(cache_root)
+    cache.remember(video_path, digest)
+    ear_values, fps, features, _ = run_branches(video_path, cache, parallel=False)
+    voice = {k: float(features[k]) for k in VOICE_FEATURES}
+    FeatureStore(features_root).store(digest, ear_values, fps, voice)
+    return ear_values, fps, voice
+
+
+def run(video_dir=VIDEO_DIR, results_dir=RESULTS_DIR, workers=2, force=False, db_path=None):
+    # Признаки (EAR-ряд и голос) извлекаются только для роликов, которых нет
+    # в хранилище признаков; подсчёт морганий по порогу и оценка KSS
+    # пересчитываются для всех, так что смена порога или весов не требует
+    # повторного FaceMesh. Ролики, удалённые по сроку хранения, оцениваются по
+    # сохранённым признакам. Хранилище пополняется после каждого ролика, так
+    # что прерванный прогон продолжится с места остановки.
+    video_dir = Path(video_dir)
+    results_dir = Path(results_dir)
+    cache = EarCache(video_dir / ".ear_cache")
+    features = FeatureStore(video_dir / ".features")
+    store = open_calibration_store(video_dir, db_path)
+
+    clips = []
+    for user_id, clip, digest in find_clips(video_dir):
+        calibration = store.get(user_id)
+        if calibration is None or calibration.get('second_video') == "None":
+            print(f"[BATCH] {clip}: пользователь не прошёл калибровку, пропуск")
+            continue
+        if calibration_outdated(calibration):
+            print(f"[BATCH] {clip}: калибровка старой версии признаков, пропуск")
+            continue
+        clips.append((user_id, clip, calibration, digest or file_digest(clip)))
+
+    records = {}
+    stale = {}
+    for user_id, clip, calibration, digest in clips:
+        record = None if force else features.load(digest)
+        if record is not None:
+            records[digest] = record
+        elif clip.exists():
+            stale[digest] = clip
+        else:
+            print(f"[BATCH] {clip}: ролик удалён, а его признаки не сохранены, пропуск")
+    print(f"[BATCH] Клипов: {len(clips)}, к извлечению признаков: {len(stale)}")
+
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=warm_up) as pool:
+            futures = {pool.submit(extract_clip, clip, digest, cache.root, features.root): digest
+                       for digest, clip in stale.items()}
+            for future in as_completed(futures):
+                digest = futures[future]
+                try:
+                    records[digest] = future.result()
+                except Exception as e:
+                    print(f"[BATCH] {stale[digest]}: {type(e).__name__}: {e}")
+
+    rows = []
+    for user_id, clip, calibration, digest in clips:
+        if digest not in records:
+            continue
+        ear_values, clip_fps, voice = records[digest]
+        ear_values = select_ear(ear_values, calibration.get('EAR_EYE', 'both'))
+        # Частота кадров — из калибровки, как у бота (main.load_user_calibration),
+        # чтобы пересчёт неизменного ролика повторял оценку бота. fps самого
+        # ролика — только для калибровок без FPS.
+        fps = calibration.get('FPS') or clip_fps
+        _, blink_rate, avg_dur = analyze_ear_sequence(ear_values, calibration['EAR_THRESHOLD'], fps)
+        rows.append({
+            'user_id': user_id,
+            'clip': str(clip),
+            'digest': digest,
+            'blink_rate': blink_rate,
+            'avg_dur': avg_dur,
+            **{k: voice[k] for k in VOICE_FEATURES},
+            'calibration': calibration,
+        })
+
+    # Все клипы оцениваются одним вызовом: строка признаков против калибровки её пользователя
+    current = feature_matrix(rows)
+    baseline = feature_matrix([r['calibration'] for r in rows])
+    contributions = WEIGHTS * feature_contributions(baseline, current)
+    fatigue = contributions.sum(axis=1)
+    kss = fatigue_to_absolute_kss(fatigue, np.array([r['calibration']['KSS_baseline'] for r in rows], dtype=float))
+    for row, score, level in zip(rows, fatigue, kss):
+        del row['calibration']
+        row['fatigue'] = float(score)
+        row['kss'] = int(level)
+
+    results_dir.mkdir(parents=True, exist_ok=True)
+    out = results_dir / "scores.npz"
+    np.savez(
+        out,
+        user_id=np.array([r['user_id'] for r in rows], dtype=str),
+        clip=np.array([r['clip'] for r in rows], dtype=str),
+        digest=np.array([r['digest'] for r in rows], dtype=str),
+        kss=kss.astype(np.int8),
+        fatigue=fatigue,
+        **{f: current[:, i] for i, f in enumerate(FEATURES)},
+        features=np.array(FEATURES),
+        contributions=contributions,
+    )
+    print(f"[BATCH] Оценено клипов: {len(rows)}, результаты: {out}")
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Пакетный пересчёт признаков и KSS по каталогу videos/")
+    parser.add_argument("--videos", default=str(VIDEO_DIR))
+    parser.add_argument("--out", default=str(RESULTS_DIR))
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--force", action="store_true", help="игнорировать сохранённые признаки и извлечь их заново")
+    parser.add_argument("--db", default=os.getenv("CALIBRATION_DB"), help="SQLite-хранилище калибровок")
+    args = parser.parse_args()
+
+    run(args.videos, args.out, args.workers, args.force, args.db)
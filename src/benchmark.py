@@ -0,0 +1,336 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import parselmouth
+import scipy.signal as sps
+from parselmouth.praat import call
+
+from src.analysis_queue import AnalysisQueue
+from src.blink_detector import segment_blinks
+from src.blinks_analysis import (EYE_INDICES, analyze_ear_sequence, analyze_video, compute_ear_batch,
+                                 extract_ear_sequence)
+from src.fatigue_calc import FEATURES, calculate_fatigue, fatigue_scores, fatigue_to_absolute_kss
+from src.sound_analysis import (apply_vad, bandpass_filter, compute_pitch_jitter_shimmer, compute_spectral_features,
+                                compute_speech_rate, load_audio_from_video)
+
+FIXTURE_DIR = Path.cwd() / "bench_fixtures"
+BASELINE_FILE = Path.cwd() / "bench_baseline.json"
+
+FPS = 30
+SR = 22050
+DURATION_SEC = 20.0
+SIZE = 384
+EAR_THRESHOLD = 0.25
+# Моргания: (начало, длительность) в секундах
+BLINKS = [(1.5, 0.15), (4.0, 0.2), (7.2, 0.15), (10.0, 0.3), (13.5, 0.18), (17.0, 0.25)]
+F0_HZ = 140.0
+JITTER = 0.01
+SHIMMER = 0.05
+# Паузы в речи: (начало, длительность) в секундах
+PAUSES = [(5.0, 0.8), (11.0, 1.2), (16.0, 0.6)]
+SYLLABLES_PER_SEC = 4.0
+# Допустимое отклонение найденной F0 от заданной и падение доли кадров с лицом
+F0_TOLERANCE = 0.05
+FACE_RATIO_DROP = 0.02
+# На отрисованном ролике лицо должно находиться почти на каждом кадре и без эталона
+MIN_FACE_RATIO = 0.9
+# Praat-стадия не должна быть медленнее исходного пути (praat_reference) на тех же сегментах
+PRAAT_MAX_RATIO = 1.0
+
+
+def _openness(t):
+    # 1 — глаз открыт, 0 — закрыт; моргание — треугольный провал
+    level = np.ones_like(t)
+    for start, dur in BLINKS:
+        phase = (t - start) / dur
+        inside = (phase >= 0) & (phase <= 1)
+        level[inside] = np.minimum(level[inside], np.abs(2 * phase[inside] - 1))
+    return level
+
+
+def make_landmark_series(duration_sec=DURATION_SEC, fps=FPS, seed=0):
+    # Ряд (N, 12, 2) глазных точек с заданными морганиями и небольшим шумом
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration_sec * fps)) / fps
+    openness = _openness(t)
+    eye = np.array([[-1, 0], [-0.4, -0.35], [0.4, -0.35], [1, 0], [0.4, 0.35], [-0.4, 0.35]], dtype=float) * 15
+    pts = np.empty((len(t), len(EYE_INDICES), 2))
+    for side, cx in enumerate((150.0, 234.0)):
+        block = np.repeat(eye[None], len(t), axis=0)
+        block[:, :, 1] *= 0.05 + 0.95 * openness[:, None]
+        block[:, :, 0] += cx
+        block[:, :, 1] += 170.0
+        pts[:, side * 6:(side + 1) * 6] = block
+    return pts + rng.normal(0, 0.3, pts.shape)
+
+
+def make_voice(duration_sec=DURATION_SEC, sr=SR, f0=F0_HZ, jitter=JITTER, shimmer=SHIMMER, seed=0):
+    # Импульсный источник с заданными F0, jitter и shimmer через два форманта,
+    # слоговая огибающая и паузы
+    rng = np.random.default_rng(seed)
+    n = int(duration_sec * sr)
+    source = np.zeros(n)
+    pos = 0.0
+    while pos < n:
+        source[int(pos)] = 1.0 + rng.normal(0, shimmer)
+        pos += sr / f0 * (1 + rng.normal(0, jitter))
+
+    y = source
+    for formant, bw in ((700, 130), (1200, 150)):
+        r = np.exp(-np.pi * bw / sr)
+        theta = 2 * np.pi * formant / sr
+        y = sps.lfilter([1 - r], [1, -2 * r * np.cos(theta), r * r], y)
+
+    t = np.arange(n) / sr
+    envelope = 0.55 + 0.45 * np.sin(2 * np.pi * SYLLABLES_PER_SEC * t)
+    for start, dur in PAUSES:
+        envelope[(t >= start) & (t < start + dur)] = 0.0
+    y = y * envelope
+    return (0.3 * y / np.max(np.abs(y))).astype(np.float32)
+
+
+def render_frame(openness):
+    # Условное «лицо»: овал, глаза-эллипсы и рот; высота глаз — openness
+    frame = np.full((SIZE, SIZE, 3), 40, dtype=np.uint8)
+    cv2.ellipse(frame, (192, 200), (110, 140), 0, 0, 360, (150, 180, 220), -1)
+    for cx in (150, 234):
+        cv2.ellipse(frame, (cx, 170), (22, 12), 0, 0, 360, (255, 255, 255), -1)
+        cv2.ellipse(frame, (cx, 170), (22, max(1, int(12 * openness))), 0, 0, 360, (60, 40, 30), -1)
+    cv2.ellipse(frame, (192, 270), (35, 10), 0, 0, 360, (80, 60, 160), -1)
+    return frame
+
+
+def make_video(path, duration_sec=DURATION_SEC, fps=FPS, sr=SR):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    audio_path = path.with_suffix(".f32")
+    make_voice(duration_sec, sr).tofile(audio_path)
+    cmd = [
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{SIZE}x{SIZE}", "-r", str(fps), "-i", "pipe:0",
+        "-f", "f32le", "-ar", str(sr), "-ac", "1", "-i", str(audio_path),
+        "-c:v", "mpeg4", "-q:v", "4", "-c:a", "aac", "-shortest",
+        str(path),
+    ]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    t = np.arange(int(duration_sec * fps)) / fps
+    for level in _openness(t):
+        proc.stdin.write(render_frame(level).tobytes())
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError("FFmpeg не смог собрать тестовое видео")
+    audio_path.unlink()
+    return path
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def praat_reference(y, sr, intervals, pitch_floor=75, pitch_ceiling=500):
+    # Исходный путь: to_pitch() и "To PointProcess (periodic, cc)" по каждому
+    # сегменту. Время меряется в том же прогоне, поэтому сравнение с ним не
+    # зависит от машины и от сохранённого эталона.
+    for start, end in intervals:
+        snd = parselmouth.Sound(y[start:end], sampling_frequency=sr)
+        snd.to_pitch(pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling)
+        point_process = call(snd, "To PointProcess (periodic, cc)", pitch_floor, pitch_ceiling)
+        call(point_process, "Get jitter (local)", 0, 0, 0.0001, 0.02, 1.3)
+
+
+def _timed(fn, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def import_time(module):
+    # Холодный импорт в отдельном интерпретаторе, включая запуск самого Python
+    env = {**os.environ, "TELEGRAM_BOT_TOKEN": os.getenv("TELEGRAM_BOT_TOKEN", "0:bench")}
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], check=True, env=env)
+    return time.perf_counter() - start
+
+
+def worker_spawn_time():
+    # От создания пула до первого выполненного задания: spawn, импорт и прогрев воркера
+    start = time.perf_counter()
+    queue = AnalysisQueue(max_workers=1, max_pending=1, job_timeout=0)
+    try:
+        queue.submit(os.getpid).result()
+    finally:
+        queue.shutdown()
+    return time.perf_counter() - start
+
+
+def run(repeat=3, fixture_dir=FIXTURE_DIR):
+    video = Path(fixture_dir) / "synthetic.mp4"
+    if not video.exists():
+        make_video(video)
+    n_frames = int(DURATION_SEC * FPS)
+    results = {}
+
+    def record(name, seconds, frames=None, audio_sec=None, **extra):
+        entry = {'seconds': seconds, **extra}
+        if frames:
+            entry['frames_per_sec'] = frames / seconds if seconds > 0 else 0.0
+        if audio_sec:
+            entry['audio_sec_per_sec'] = audio_sec / seconds if seconds > 0 else 0.0
+        results[name] = entry
+
+    # Видео: по записанному ряду точек и по отрисованному ролику
+    pts = make_landmark_series()
+    sec, (blink_count, _, _) = _timed(
+        lambda: analyze_ear_sequence(compute_ear_batch(pts).mean(axis=-1), EAR_THRESHOLD, FPS), repeat)
+    record("ear_series", sec, frames=n_frames, blinks_expected=len(BLINKS), blinks_found=blink_count)
+    ear_mean = compute_ear_batch(pts).mean(axis=-1)
+    thresholds = np.linspace(0.15, 0.35, 200)
+    sec, _ = _timed(lambda: [segment_blinks(ear_mean, th, FPS) for th in thresholds], repeat)
+    record("threshold_sweep_x200", sec, frames=n_frames * len(thresholds))
+
+    sec, (ear_values, fps) = _timed(lambda: extract_ear_sequence(video), repeat)
+    record("extract_ear_sequence", sec, frames=len(ear_values),
+           face_ratio=float(np.mean(~np.isnan(ear_values))) if len(ear_values) else 0.0)
+    sec, (blink_count, _, _) = _timed(lambda: analyze_video(video, EAR_THRESHOLD, fps), repeat)
+    record("analyze_video", sec, frames=len(ear_values), blinks_expected=len(BLINKS), blinks_found=blink_count)
+
+    # Аудио по стадиям analyze_audio
+    sec, (y, sr) = _timed(lambda: load_audio_from_video(video), repeat)
+    audio_sec = len(y) / sr
+    record("audio_decode", sec, audio_sec=audio_sec)
+    sec, _ = _timed(lambda: load_audio_from_video(video, prefilter=True), repeat)
+    record("audio_decode_bandpass", sec, audio_sec=audio_sec)
+    sec, y_f = _timed(lambda: bandpass_filter(y, sr), repeat)
+    record("bandpass", sec, audio_sec=audio_sec)
+    sec, (y_v, intervals) = _timed(lambda: apply_vad(y_f, sr, return_intervals=True), repeat)
+    record("vad", sec, audio_sec=audio_sec)
+    sec, _ = _timed(lambda: compute_spectral_features(y_v, sr), repeat)
+    record("spectral", sec, audio_sec=len(y_v) / sr)
+    sec, (f0_mean, jitter, shimmer) = _timed(lambda: compute_pitch_jitter_shimmer(y_f, sr, intervals), repeat)
+    record("praat", sec, audio_sec=len(y_v) / sr, f0_expected=F0_HZ, f0_found=float(f0_mean))
+    sec, _ = _timed(lambda: praat_reference(y_f, sr, intervals), repeat)
+    record("praat_reference", sec, audio_sec=len(y_v) / sr)
+    sec, wpm = _timed(lambda: compute_speech_rate(y_f, sr, "ru-RU", intervals), repeat)
+    record("speech_rate", sec, audio_sec=audio_sec, wpm=float(wpm))
+
+    # Оценка усталости целиком
+    baseline = {
+        'blink_rate': 18.0, 'avg_dur': 150.0, 'spectral_centroid_mean': 1500.0, 'spectral_flux_mean': 0.05,
+        'rms_db_mean': -20.0, 'f0_mean_hz': 130.0, 'jitter_percent': 0.01, 'shimmer_db': 0.3,
+        'speech_rate_wpm': 100.0,
+    }
+    current = {k: v * 1.1 for k, v in baseline.items()}
+    sec, _ = _timed(lambda: [fatigue_to_absolute_kss(calculate_fatigue(baseline, current), 5)
+                             for _ in range(10000)], repeat)
+    record("fatigue_x10000", sec)
+    rng = np.random.default_rng(0)
+    baselines = np.array([baseline[f] for f in FEATURES]) * rng.uniform(0.8, 1.2, (1_000_000, len(FEATURES)))
+    rows = baselines * rng.uniform(0.8, 1.2, baselines.shape)
+    sec, _ = _timed(lambda: fatigue_to_absolute_kss(fatigue_scores(baselines, rows), 5), repeat)
+    record("fatigue_matrix_1e6", sec)
+
+    # Запуск бота и воркеров
+    for name, module in (("startup_python", "sys"), ("startup_bot", "src.main"), ("startup_pipeline", "src.pipeline")):
+        sec, _ = _timed(lambda: import_time(module), repeat)
+        record(name, sec)
+    sec, _ = _timed(worker_spawn_time, repeat)
+    record("worker_spawn", sec)
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, entry in results.items():
+        if not isinstance(entry, dict) or name not in baseline:
+            continue
+        before = baseline[name]['seconds']
+        if before > 0 and entry['seconds'] > before * (1 + tolerance):
+            regressions.append((name, before, entry['seconds']))
+    return regressions
+
+
+def check_accuracy(results, baseline=None):
+    # Точность не зависит от машины, поэтому проверяется и без эталона:
+    # моргания и F0 — против заданных в синтетике, доля кадров с лицом — против
+    # абсолютного порога и против эталона
+    failures = []
+    for name in ('ear_series', 'analyze_video'):
+        entry = results.get(name)
+        if entry and entry['blinks_found'] != entry['blinks_expected']:
+            failures.append((name, f"найдено морганий {entry['blinks_found']} из {entry['blinks_expected']}"))
+    entry = results.get('praat')
+    # not (<=), чтобы NaN тоже считался ошибкой
+    if entry and not abs(entry['f0_found'] - entry['f0_expected']) <= F0_TOLERANCE * entry['f0_expected']:
+        failures.append(('praat', f"F0 {entry['f0_found']:.1f} Гц вместо {entry['f0_expected']:.1f} Гц"))
+    entry = results.get('extract_ear_sequence')
+    if entry and entry['face_ratio'] < MIN_FACE_RATIO:
+        failures.append(('extract_ear_sequence', f"лицо найдено на {entry['face_ratio']:.1%} кадров, "
+                                                 f"нужно не меньше {MIN_FACE_RATIO:.0%}"))
+    before = (baseline or {}).get('extract_ear_sequence', {}).get('face_ratio')
+    if entry and before is not None and entry['face_ratio'] < before - FACE_RATIO_DROP:
+        failures.append(('extract_ear_sequence', f"лицо найдено на {entry['face_ratio']:.1%} кадров, "
+                                                 f"в эталоне {before:.1%}"))
+    return failures
+
+
+def check_speed(results):
+    # Замедления относительно исходного алгоритма в том же прогоне
+    failures = []
+    praat, reference = results.get('praat'), results.get('praat_reference')
+    if praat and reference and praat['seconds'] > reference['seconds'] * PRAAT_MAX_RATIO:
+        failures.append(('praat', f"{praat['seconds']:.3f}s при {reference['seconds']:.3f}s у to_pitch() + "
+                                  f"periodic cc"))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера на синтетических данных")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=str(BASELINE_FILE))
+    parser.add_argument("--save-baseline", action="store_true", help="записать результаты как новый эталон")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое замедление, доля")
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    print(json.dumps(results, indent=4, ensure_ascii=False))
+
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() and not args.save_baseline else None
+    failures = check_accuracy(results, baseline)
+    for name, message in failures:
+        print(f"[BENCH] Точность {name}: {message}")
+    slow = check_speed(results)
+    for name, message in slow:
+        print(f"[BENCH] Медленнее исходного {name}: {message}")
+    failures += slow
+    if failures:
+        # Неверный результат не годится ни для сравнения, ни в эталон
+        sys.exit(1)
+
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(results, indent=4))
+        print(f"[BENCH] Эталон сохранён: {baseline_path}")
+    elif baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            print(f"[BENCH] Регрессия {name}: {before:.4f}s -> {after:.4f}s")
+        if regressions:
+            sys.exit(1)
+        print("[BENCH] Регрессий нет")
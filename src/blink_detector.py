@@ -0,0 +1,128 @@
+import math
+from collections import deque
+
+import numpy as np
+
+
+class BlinkDetector:
+    # Инкрементальный детектор: получает по одному значению EAR с меткой
+    # времени (в секундах) и сразу возвращает длительность закончившегося
+    # моргания в мс. Правила те же, что у segment_blinks: начало — первый кадр
+    # ниже порога, конец — подъём до ear_threshold * (1 + hysteresis), кадры
+    # без лица повторяют предыдущее значение, моргание на конце записи
+    # закрывается flush(). Частота и средняя длительность считаются по
+    # последним rate_window_sec секундам.
+    def __init__(self, ear_threshold, consec_frames=2, min_duration_ms=50, rate_window_sec=60.0,
+                 max_duration_ms=None, hysteresis=0.05):
+        self.ear_threshold = ear_threshold
+        self.consec_frames = consec_frames
+        self.min_duration_ms = min_duration_ms
+        self.max_duration_ms = max_duration_ms
+        self.hysteresis = hysteresis
+        self.rate_window_sec = rate_window_sec
+        self.events = deque()
+        self.blink_count = 0
+        self.total_duration_ms = 0.0
+        self._closed = 0
+        self._blink_start = None
+        self._last_ear = None
+        self._t_first = None
+        self._t_last = None
+
+    def update(self, ear, t):
+        if self._t_first is None:
+            self._t_first = t
+        self._t_last = t
+        if math.isnan(ear):
+            if self._last_ear is None:
+                return None
+            ear = self._last_ear
+        self._last_ear = ear
+
+        if ear < self.ear_threshold * (1 + self.hysteresis):
+            if ear < self.ear_threshold:
+                if self._blink_start is None:
+                    self._blink_start = t
+                self._closed += 1
+            return None
+
+        event = self._finish(t)
+        self.prune(t)
+        return event
+
+    def flush(self, t_end):
+        # Конец записи: t_end — время сразу после последнего кадра
+        # (как конец ряда в segment_blinks)
+        event = self._finish(t_end)
+        self._last_ear = None
+        return event
+
+    def _finish(self, t):
+        event = None
+        if self._blink_start is not None and self._closed >= max(self.consec_frames, 1):
+            duration_ms = (t - self._blink_start) * 1000.0
+            if duration_ms > self.min_duration_ms and (self.max_duration_ms is None
+                                                       or duration_ms <= self.max_duration_ms):
+                event = duration_ms
+                self.blink_count += 1
+                self.total_duration_ms += duration_ms
+                self.events.append((t, duration_ms))
+        self._closed = 0
+        self._blink_start = None
+        return event
+
+    def prune(self, now):
+        while self.events and self.events[0][0] <= now - self.rate_window_sec:
+            self.events.popleft()
+
+    def blink_rate(self, now=None):
+        now = self._t_last if now is None else now
+        if now is None:
+            return 0.0
+        self.prune(now)
+        span_min = min(self.rate_window_sec, now - self._t_first) / 60
+        return len(self.events) / span_min if span_min > 0 else 0.0
+
+    def avg_duration(self):
+        if not self.events:
+            return 0.0
+        return sum(d for _, d in self.events) / len(self.events)
+
+    def total_avg_duration(self):
+        return self.total_duration_ms / self.blink_count if self.blink_count else 0.0
+
+
+def segment_blinks(ear_values, ear_threshold, fps, consec_frames=2, min_duration_ms=50, max_duration_ms=None,
+                   hysteresis=0.05):
+    # Разметка морганий по всему ряду EAR сразу, без цикла по кадрам.
+    # Моргание начинается на первом кадре ниже порога и длится, пока EAR не
+    # поднимется до ear_threshold * (1 + hysteresis); внутри него должно быть
+    # не меньше consec_frames кадров ниже порога. Кадры без лица (NaN)
+    # повторяют предыдущее значение, моргание на конце ряда тоже учитывается.
+    # Возвращает индексы начала, конца (не включая) и длительности в мс.
+    ear = np.asarray(ear_values, dtype=float)
+    n = len(ear)
+    if n == 0 or fps <= 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+
+    last_valid = np.where(np.isnan(ear), 0, np.arange(n))
+    np.maximum.accumulate(last_valid, out=last_valid)
+    ear = ear[last_valid]
+
+    closed = ear < ear_threshold
+    held = ear < ear_threshold * (1 + hysteresis)
+    edges = np.diff(np.concatenate(([0], held.astype(np.int8), [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+
+    closed_before = np.concatenate(([0], np.cumsum(closed)))
+    keep = closed_before[run_ends] - closed_before[run_starts] >= max(consec_frames, 1)
+    run_starts, ends = run_starts[keep], run_ends[keep]
+    closed_idx = np.flatnonzero(closed)
+    starts = closed_idx[np.searchsorted(closed_idx, run_starts)]
+
+    durations = (ends - starts) * 1000.0 / fps
+    ok = durations > min_duration_ms
+    if max_duration_ms is not None:
+        ok &= durations <= max_duration_ms
+    return starts[ok], ends[ok], durations[ok]
@@ -1,138 +1,220 @@
 import json
 from pathlib import Path
 
-import cv2
 import numpy as np
-import mediapipe as mp
 import time
-import matplotlib.pyplot as plt
+
+from src.blink_detector import segment_blinks
+from src.ear_calibration import fit_threshold
+from src.face_roi import FaceRoiTracker
+from src.instrumentation import record_stage
+from src.landmark_engine import get_landmark_engine
+from src.media import MediaStream, average_fps, i420_to_rgb, open_media
 
 
 LEFT_EYE_INDICES   = [33, 160, 158, 133, 153, 144]
 RIGHT_EYE_INDICES  = [263, 385, 387, 362, 380, 373]
 
-def compute_ear(landmarks, eye_idxs):
-    pts = np.array([landmarks[i] for i in eye_idxs])
-    A = np.linalg.norm(pts[1] - pts[5])
-    B = np.linalg.norm(pts[2] - pts[4])
-    C = np.linalg.norm(pts[0] - pts[3])
+EYE_INDICES = LEFT_EYE_INDICES + RIGHT_EYE_INDICES
+
+
+def gather_eye_points(landmarks, w, h, out=None, x0=0, y0=0):
+    # Берём из 478 точек FaceMesh только 12 глазных, без округления до пикселей.
+    # w, h, x0, y0 — размер и смещение поданного в FaceMesh кадра (или его вырезки)
+    if out is None:
+        out = np.empty((len(EYE_INDICES), 2))
+    for i, idx in enumerate(EYE_INDICES):
+        p = landmarks[idx]
+        out[i, 0] = x0 + p.x * w
+        out[i, 1] = y0 + p.y * h
+    return out
+
+
+def compute_ear_batch(eye_pts):
+    # eye_pts: (..., 12, 2) — 6 точек левого глаза, затем 6 правого.
+    # Возвращает (..., 2): EAR левого и правого глаза.
+    pts = np.asarray(eye_pts, dtype=float)
+    eyes = pts.reshape(pts.shape[:-2] + (2, 6, 2))
+    A = np.linalg.norm(eyes[..., 1, :] - eyes[..., 5, :], axis=-1)
+    B = np.linalg.norm(eyes[..., 2, :] - eyes[..., 4, :], axis=-1)
+    C = np.linalg.norm(eyes[..., 0, :] - eyes[..., 3, :], axis=-1)
     return (A + B) / (2.0 * C)
 
 
-def extract_ear_sequence(video_path):
-    mp_face = mp.solutions.face_mesh
-    with mp_face.FaceMesh(
-        static_image_mode=False,
-        max_num_faces=1,
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5
-    ) as face_mesh:
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            raise IOError(f"Не удалось открыть видео: {video_path}")
-
-        fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
-        ear_values = []
-
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            h, w = frame.shape[:2]
-            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            results = face_mesh.process(rgb)
-            if results.multi_face_landmarks:
-                lm = results.multi_face_landmarks[0].landmark
-                pts = [(int(p.x * w), int(p.y * h)) for p in lm]
-                ear_l = compute_ear(pts, LEFT_EYE_INDICES)
-                ear_r = compute_ear(pts, RIGHT_EYE_INDICES)
-                ear_values.append((ear_l + ear_r) / 2.0)
-        cap.release()
-    return ear_values, fps
-
-
-def plot_ear_histogram(ear_open, ear_blink, threshold):
-    plt.figure(figsize=(8,4))
-    plt.hist(ear_open, bins=50, alpha=0.6, label='Open')
-    plt.hist(ear_blink, bins=50, alpha=0.6, label='Blink')
-    plt.axvline(threshold, color='red', linestyle='--', label=f'TH={threshold:.3f}')
-    plt.legend()
-    plt.title('Калибровка порога EAR')
-    plt.xlabel('EAR')
-    plt.ylabel('Частота')
-    plt.show()
-
-
-def calibrate_threshold(open_video, blink_video):
+def select_ear(ear, eye='both'):
+    # ear: (..., 2) — EAR левого и правого глаза. eye='both' — среднее,
+    # 'left'/'right' — один глаз, None — оба столбца как есть
+    ear = np.asarray(ear, dtype=float)
+    if eye is None:
+        return ear
+    if eye == 'both':
+        return ear.mean(axis=-1)
+    return ear[..., 0 if eye == 'left' else 1]
+
+
+def iter_eye_points(media, ear_threshold=None, stride=1, margin=0.25, roi=True, stats=None):
+    # По кадру выдаёт массив (12, 2) глазных точек в пикселях кадра, NaN — лица нет.
+    # Адаптивная выборка: пока EAR заметно выше порога (глаза открыты), FaceMesh
+    # запускается раз в stride кадров, а пропущенные кадры повторяют последние
+    # точки. Как только EAR подходит к порогу ближе margin — снова каждый кадр.
+    # При roi=True в FaceMesh идёт только вырезка вокруг лица с прошлого кадра.
+    # Точки пишутся в один и тот же массив: выданное значение действительно до
+    # следующего шага, дольше его нужно копировать (как _extract_eye_points).
+    adaptive = stride > 1 and ear_threshold is not None
+    tracker = FaceRoiTracker() if roi else None
+    open_level = ear_threshold * (1.0 + margin) if adaptive else None
+    engine = get_landmark_engine()
+    engine.start_video()
+    no_face = np.full((len(EYE_INDICES), 2), np.nan)
+    scratch = np.empty((len(EYE_INDICES), 2))
+    pts = no_face
+    last_ear = None
+    skipped = 0
+    # Число инференсов и время декодирования, FaceMesh и EAR копятся в stats
+    stats = {} if stats is None else stats
+    stats.update(inferences=0, decode_s=0.0, facemesh_s=0.0, ear_s=0.0)
+    frames = media.frames()
+    while True:
+        t0 = time.perf_counter()
+        frame = next(frames, None)
+        stats['decode_s'] += time.perf_counter() - t0
+        if frame is None:
+            break
+        if adaptive and last_ear is not None and last_ear > open_level and skipped < stride - 1:
+            skipped += 1
+            yield pts
+            continue
+        skipped = 0
+        t0 = time.perf_counter()
+        if tracker is not None:
+            rgb, x0, y0 = tracker.crop(frame, media.width, media.height)
+        else:
+            rgb, x0, y0 = i420_to_rgb(frame), 0, 0
+        t1 = time.perf_counter()
+        stats['decode_s'] += t1 - t0
+        lm = engine.process(rgb)
+        stats['inferences'] += 1
+        if lm is None and tracker is not None and tracker.box is not None:
+            # Лицо ушло из рамки — ищем по всему кадру
+            tracker.reset()
+            rgb, x0, y0 = i420_to_rgb(frame), 0, 0
+            lm = engine.process(rgb)
+            stats['inferences'] += 1
+        t2 = time.perf_counter()
+        stats['facemesh_s'] += t2 - t1
+        h, w = rgb.shape[:2]
+        if lm is not None:
+            pts = gather_eye_points(lm, w, h, scratch, x0, y0)
+            if tracker is not None:
+                tracker.update(lm, x0, y0, w, h, media.width, media.height)
+            if adaptive:
+                last_ear = compute_ear_batch(pts).mean()
+        else:
+            pts = no_face
+            last_ear = None
+        stats['ear_s'] += time.perf_counter() - t2
+        yield pts
+
+
+def _extract_eye_points(media, ear_threshold=None, stride=1, margin=0.25, roi=True):
+    stats = {}
+    eye_pts = np.full((512, len(EYE_INDICES), 2), np.nan)
+    n = 0
+    for pts in iter_eye_points(media, ear_threshold, stride, margin, roi, stats):
+        if n == len(eye_pts):
+            eye_pts = np.concatenate([eye_pts, np.full_like(eye_pts, np.nan)])
+        eye_pts[n] = pts
+        n += 1
+    if n:
+        record_stage('decode', stats['decode_s'])
+        record_stage('facemesh', stats['facemesh_s'])
+        record_stage('ear', stats['ear_s'])
+    return eye_pts[:n], stats['inferences']
+
+
+def extract_ear_sequence(video, cache=None, ear_threshold=None, stride=1, margin=0.25, roi=True, eye='both'):
+    # video — путь к файлу или уже открытый MediaStream (общий с аудиоанализом).
+    # Кадры без лица попадают в последовательность как NaN, чтобы индексы
+    # совпадали с номерами кадров. В кэш пишутся только полные ряды (stride=1),
+    # но готовый полный ряд из кэша подходит и для адаптивного режима.
+    # В кэше хранятся EAR обоих глаз, eye выбирает ряд (см. select_ear).
+    video_path = video.path if isinstance(video, MediaStream) else video
+    full_rate = stride <= 1 or ear_threshold is None
+    if cache is not None:
+        cached = cache.load(video_path)
+        if cached is not None:
+            ear_values, fps, _ = cached
+            return select_ear(ear_values, eye), fps
+
+    media = video if isinstance(video, MediaStream) else open_media(video, audio=False)
+    try:
+        eye_pts, _ = _extract_eye_points(media, ear_threshold, stride, margin, roi)
+    finally:
+        if media is not video:
+            media.close()
+    ear_values = compute_ear_batch(eye_pts)
+    timestamps = media.timestamps()
+    fps = average_fps(timestamps, media.fps)
+    if cache is not None and full_rate:
+        cache.store(video_path, ear_values, fps, timestamps)
+    return select_ear(ear_values, eye), fps
+
+
+def compare_sampling(video_path, ear_threshold, fps, consec_frames=2, stride=3, margin=0.25):
+    # Сравнение адаптивной выборки с покадровым проходом на одном и том же видео
+    report = {}
+    for mode, mode_stride in (('full', 1), ('adaptive', stride)):
+        with open_media(video_path, audio=False) as media:
+            eye_pts, inferences = _extract_eye_points(media, ear_threshold, mode_stride, margin)
+        ear_values = compute_ear_batch(eye_pts).mean(axis=-1)
+        blink_count, blink_rate, avg_dur = analyze_ear_sequence(ear_values, ear_threshold, fps, consec_frames)
+        report[mode] = {
+            'frames': len(ear_values),
+            'inferences': inferences,
+            'blink_count': blink_count,
+            'avg_dur': float(avg_dur),
+        }
+
+    full, adaptive = report['full'], report['adaptive']
+    report['blink_count_error'] = adaptive['blink_count'] - full['blink_count']
+    report['avg_dur_error_ms'] = adaptive['avg_dur'] - full['avg_dur']
+    report['inference_ratio'] = adaptive['inferences'] / full['inferences'] if full['inferences'] else 0.0
+    print(f"[SAMPLING] stride={stride}: blinks {full['blink_count']} -> {adaptive['blink_count']}, "
+          f"avg_dur {full['avg_dur']:.1f} -> {adaptive['avg_dur']:.1f} ms, "
+          f"inferences {full['inferences']} -> {adaptive['inferences']}")
+    return report
+
+
+def threshold_from_ear(ear_open, ear_blink):
+    # ear_open, ear_blink: (N,) или (N, 2) по глазам. Возвращает результат
+    # fit_threshold: порог, глаз и уверенность; плохие ролики — CalibrationRejected
+    fit = fit_threshold(ear_open, ear_blink)
+    chosen = fit['eyes'][fit['eye']]
+    print(f"[CALIBRATION] open={chosen['open']:.3f}, closed={chosen['closed']:.3f}, eye={fit['eye']}, "
+          f"EAR_THRESHOLD={fit['threshold']:.3f}, confidence={fit['confidence']:.2f}")
+
+    return fit
+
+
+def calibrate_threshold(open_video, blink_video, cache=None):
     print(open_video,blink_video)
-    ear_open, _ = extract_ear_sequence(open_video)
-    ear_blink, fps = extract_ear_sequence(blink_video)
-
-    mean_open = np.mean(ear_open)
-    mean_closed = np.min(ear_blink)
-
-    ear_threshold = (mean_open + mean_closed) / 2.0
-    print(f"[CALIBRATION] mean_open={mean_open:.3f}, mean_closed={mean_closed:.3f}, EAR_THRESHOLD={ear_threshold:.3f}")
-
-    return ear_threshold, fps
-
-
-def analyze_video(video_path, ear_threshold, fps, consec_frames=2):
-    mp_face = mp.solutions.face_mesh
-    with mp_face.FaceMesh(
-        static_image_mode=False,
-        max_num_faces=1,
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5
-    ) as face_mesh:
-        cap = cv2.VideoCapture(video_path)
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        if not cap.isOpened():
-            raise IOError(f"Не удалось открыть видео: {video_path}")
-
-        blink_count = 0
-        consec = 0
-        blink_start = None
-        durations = []
-        frame_idx = 0
-
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            h, w = frame.shape[:2]
-            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            results = face_mesh.process(rgb)
-
-            if results.multi_face_landmarks:
-                lm = results.multi_face_landmarks[0].landmark
-                pts = [(int(p.x * w), int(p.y * h)) for p in lm]
-                ear = np.mean([compute_ear(pts, LEFT_EYE_INDICES), compute_ear(pts, RIGHT_EYE_INDICES)])
-
-                if ear < ear_threshold:
-                    consec += 1
-                    if consec == consec_frames:
-                        blink_start = frame_idx
-                else:
-                    if blink_start is not None:
-                        frames = frame_idx - blink_start
-                        duration_ms = frames * (1000.0 / fps)
-                        if duration_ms > 50:
-                            durations.append(duration_ms)
-                            blink_count += 1
-                        print(f"[BLINK] #{blink_count}: duration {duration_ms:.1f} ms")
-                    consec = 0
-                    blink_start = None
-            frame_idx += 1
-
-        cap.release()
+    ear_open, _ = extract_ear_sequence(open_video, cache, eye=None)
+    ear_blink, fps = extract_ear_sequence(blink_video, cache, eye=None)
+
+    return threshold_from_ear(ear_open, ear_blink)['threshold'], fps
+
 
+def analyze_ear_sequence(ear_values, ear_threshold, fps, consec_frames=2):
+    _, _, durations = segment_blinks(ear_values, ear_threshold, fps, consec_frames)
+    for i, duration_ms in enumerate(durations, 1):
+        print(f"[BLINK] #{i}: duration {duration_ms:.1f} ms")
+
+    blink_count = len(durations)
+    frame_count = len(ear_values)
     duration_sec = frame_count / fps if fps > 0 else 0
     duration_min = duration_sec / 60
     blink_rate = blink_count / duration_min if duration_min > 0 else 0
-    avg_dur = np.mean(durations) if durations else 0
+    avg_dur = float(durations.mean()) if blink_count else 0.0
 
     print(f"[ANALYSIS] Blink count: {blink_count}")
     print(f"[ANALYSIS] Blink rate: {blink_rate:.3f} blinks/min")
@@ -140,6 +222,11 @@ def analyze_video(video_path, ear_threshold, fps, consec_frames=2):
 
     return blink_count, blink_rate, avg_dur
 
+
+def analyze_video(video_path, ear_threshold, fps, consec_frames=2, cache=None, stride=1, eye='both'):
+    ear_values, _ = extract_ear_sequence(video_path, cache, ear_threshold, stride, eye=eye)
+    return analyze_ear_sequence(ear_values, ear_threshold, fps, consec_frames)
+
 # def analyze_video(video_path, consec_frames=2):
 #     user_path = video_path[:video_path.rfind('\\') + 1]
 #     audio_path = video_path.replace('.mp4', '.wav')
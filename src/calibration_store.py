@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+CALIBRATION_FILE = "calibration_data.json"
+HISTORY_FILE = "history.jsonl"
+
+
+class CalibrationStore:
+    # Калибровки пользователей с LRU-кэшем в памяти. Чтение-изменение-запись
+    # одного пользователя делается под его блокировкой (см. edit).
+    # Хранилище — JSON-файлы в videos/<user_id>/, история — history.jsonl рядом.
+    def __init__(self, root, capacity=256):
+        self.root = Path(root)
+        self.capacity = capacity
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def lock(self, user_id):
+        with self._locks_lock:
+            return self._locks.setdefault(str(user_id), threading.RLock())
+
+    def get(self, user_id):
+        # Возвращает копию, чтобы изменения вне edit() не попадали в кэш
+        key = str(user_id)
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                data = self._cache[key]
+                return dict(data) if data is not None else None
+        with self.lock(user_id):
+            data = self._read(key)
+            self._remember(key, data)
+        return dict(data) if data is not None else None
+
+    def save(self, user_id, data):
+        key = str(user_id)
+        with self.lock(user_id):
+            self._write(key, data)
+            self._remember(key, dict(data))
+
+    @contextmanager
+    def edit(self, user_id):
+        # with store.edit(uid) as data: data[...] = ... — сохраняется при выходе
+        with self.lock(user_id):
+            data = self.get(user_id)
+            if data is None:
+                raise FileNotFoundError("Пользователь не прошёл калибровку")
+            yield data
+            self.save(user_id, data)
+
+    def delete(self, user_id):
+        key = str(user_id)
+        with self.lock(user_id):
+            self._remove(key)
+            self._remember(key, None)
+
+    def add_history(self, user_id, kind, data):
+        self._append(str(user_id), {'ts': time.time(), 'kind': kind, **data})
+
+    def history(self, user_id, kind=None):
+        entries = self._history(str(user_id))
+        return [e for e in entries if kind is None or e['kind'] == kind]
+
+    def _remember(self, key, data):
+        with self._cache_lock:
+            self._cache[key] = data
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def _path(self, key):
+        return self.root / key / CALIBRATION_FILE
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key, data):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _remove(self, key):
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _append(self, key, entry):
+        path = self.root / key / HISTORY_FILE
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock(key), open(path, 'a') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _history(self, key):
+        try:
+            with open(self.root / key / HISTORY_FILE, 'r') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+
+class SqliteCalibrationStore(CalibrationStore):
+    # То же хранилище в одном файле SQLite — без россыпи мелких JSON в videos/
+    def __init__(self, db_path, capacity=256):
+        super().__init__(Path(db_path).parent, capacity)
+        self.db_path = str(db_path)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS calibration ("
+                         "user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS history ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, "
+                         "ts REAL NOT NULL, kind TEXT NOT NULL, data TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS history_user ON history (user_id, ts)")
+
+    def _connect(self):
+        # Соединение на поток: обработчики бота и колбэки очереди работают в разных потоках
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _read(self, key):
+        row = self._connect().execute("SELECT data FROM calibration WHERE user_id = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, key, data):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO calibration (user_id, data, updated_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(data), time.time()))
+
+    def _remove(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM calibration WHERE user_id = ?", (key,))
+
+    def _append(self, key, entry):
+        entry = dict(entry)
+        ts = entry.pop('ts')
+        kind = entry.pop('kind')
+        with self._connect() as conn:
+            conn.execute("INSERT INTO history (user_id, ts, kind, data) VALUES (?, ?, ?, ?)",
+                         (key, ts, kind, json.dumps(entry, ensure_ascii=False)))
+
+    def _history(self, key):
+        rows = self._connect().execute(
+            "SELECT ts, kind, data FROM history WHERE user_id = ? ORDER BY ts, id", (key,)).fetchall()
+        return [{'ts': ts, 'kind': kind, **json.loads(data)} for ts, kind, data in rows]
+
+
+def open_calibration_store(video_dir, db_path=None):
+    if db_path:
+        return SqliteCalibrationStore(db_path)
+    return CalibrationStore(video_dir)
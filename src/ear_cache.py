@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+# Меняется при изменении способа расчёта EAR, чтобы старые записи не подхватывались.
+# С версии 3 хранится EAR каждого глаза: массив (N, 2)
+CACHE_VERSION = 3
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class EarCache:
+    # Кэш покадровых EAR-рядов по хэшу содержимого видео. Записи — .npz файлы,
+    # при превышении max_bytes удаляются давно не использованные.
+    def __init__(self, root, max_bytes=256 * 1024 * 1024):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._digests = {}
+
+    def digest(self, video_path):
+        st = os.stat(video_path)
+        stamp = (str(video_path), st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(stamp)
+        if digest is None:
+            digest = file_digest(video_path)
+            self._digests[stamp] = digest
+        return digest
+
+    def remember(self, video_path, digest):
+        # Хэш уже посчитан вызывающим (batch.py) — файл не читается второй раз
+        st = os.stat(video_path)
+        self._digests[(str(video_path), st.st_size, st.st_mtime_ns)] = digest
+
+    def key_for(self, video_path):
+        return f"{self.digest(video_path)}-v{CACHE_VERSION}"
+
+    def _entry(self, key):
+        return self.root / f"{key}.npz"
+
+    def load(self, video_path):
+        return self.load_by_digest(self.digest(video_path))
+
+    def load_by_digest(self, digest):
+        entry = self._entry(f"{digest}-v{CACHE_VERSION}")
+        try:
+            with np.load(entry) as data:
+                ear_values = data['ear']
+                fps = float(data['fps'])
+                timestamps = data['timestamps']
+            # Отметка для LRU; запись могла уже удалить evict() другого процесса
+            os.utime(entry)
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+        return ear_values, fps, timestamps
+
+    def store(self, video_path, ear_values, fps, timestamps=None):
+        # timestamps — время показа кадров (MediaStream.timestamps); без них — сетка по fps
+        ear_values = np.asarray(ear_values, dtype=float)
+        if timestamps is None:
+            timestamps = np.arange(len(ear_values)) / fps if fps > 0 else np.zeros(len(ear_values))
+        self.root.mkdir(parents=True, exist_ok=True)
+        entry = self._entry(self.key_for(video_path))
+        tmp = entry.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(f, ear=ear_values, fps=np.float64(fps), timestamps=np.asarray(timestamps, dtype=float))
+        os.replace(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for p in self.root.glob("*.npz"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+            total += st.st_size
+        entries.sort()
+        for _, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class FeatureStore:
+    # Признаки проанализированных роликов по хэшу содержимого: EAR обоих глаз,
+    # fps и голосовые признаки. Записи небольшие и, в отличие от EarCache, не
+    # вытесняются — по ним пересчитываются оценки, когда сам MP4 уже удалён
+    # по сроку хранения или квоте.
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _entry(self, digest):
+        return self.root / f"{digest}-v{CACHE_VERSION}.npz"
+
+    def load(self, digest):
+        try:
+            with np.load(self._entry(digest)) as data:
+                return data['ear'], float(data['fps']), json.loads(str(data['voice']))
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+
+    def store(self, digest, ear_values, fps, voice):
+        self.root.mkdir(parents=True, exist_ok=True)
+        entry = self._entry(digest)
+        tmp = entry.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(f, ear=np.asarray(ear_values, dtype=float), fps=np.float64(fps),
+                     voice=np.array(json.dumps({k: float(v) for k, v in voice.items()})))
+        os.replace(tmp, entry)
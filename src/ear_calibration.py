@@ -0,0 +1,124 @@
+import math
+
+import numpy as np
+
+# Калибровочный ролик отклоняется, если лицо найдено меньше чем на этой доле кадров
+MIN_FACE_RATIO = 0.8
+MIN_OPEN_FRAMES = 30
+# Доля «закрытых» кадров, после которой ролик с открытыми глазами считается испорченным
+MAX_OPEN_CLOSED_RATIO = 0.1
+MIN_CLOSED_FRAMES = 2
+# Кадр считается закрытым, если EAR ниже уровня открытых глаз на OPEN_Z разбросов
+OPEN_Z = 3.0
+MIN_SPREAD = 0.01
+# Уверенность — ожидаемая доля верно классифицированных кадров; 0.75 — порог
+# в 0.67 разброса от каждого из центров
+MIN_CONFIDENCE = 0.75
+# Оба глаза предпочтительнее одного, если уверенность хуже не больше чем на столько
+BOTH_EYES_MARGIN = 0.025
+
+
+class CalibrationRejected(ValueError):
+    pass
+
+
+def _series(ear, eye):
+    # ear: (N,) или (N, 2) — EAR левого и правого глаза
+    ear = np.asarray(ear, dtype=float)
+    if ear.ndim == 1:
+        return ear
+    if eye == 'left':
+        return ear[:, 0]
+    if eye == 'right':
+        return ear[:, 1]
+    return ear.mean(axis=-1)
+
+
+def _face_frames(ear, clip):
+    valid = ear[~np.isnan(ear)]
+    ratio = len(valid) / len(ear) if len(ear) else 0.0
+    if ratio < MIN_FACE_RATIO:
+        raise CalibrationRejected(f"лицо видно только на {ratio:.0%} кадров {clip}")
+    return valid
+
+
+def _robust(values):
+    # Медиана и MAD вместо среднего и минимума: один шумный кадр их не сдвигает
+    center = float(np.median(values))
+    spread = 1.4826 * float(np.median(np.abs(values - center)))
+    return center, max(spread, MIN_SPREAD)
+
+
+def check_open_clip(ear_open):
+    # Быстрая проверка ролика с открытыми глазами сразу после загрузки
+    values = _face_frames(_series(ear_open, 'both'), "видео с открытыми глазами")
+    if len(values) < MIN_OPEN_FRAMES:
+        raise CalibrationRejected("видео с открытыми глазами слишком короткое")
+    center, spread = _robust(values)
+    closed_ratio = float(np.mean(values < center - OPEN_Z * spread))
+    if closed_ratio > MAX_OPEN_CLOSED_RATIO:
+        raise CalibrationRejected("на видео с открытыми глазами глаза часто закрываются")
+    return {'open': center, 'spread': spread, 'closed_ratio': closed_ratio}
+
+
+def _fit_eye(open_values, blink_values):
+    # Две компоненты: «открыто» — по ролику с открытыми глазами, «закрыто» —
+    # кадры ролика с морганиями, лежащие далеко ниже открытой компоненты.
+    # Порог делит расстояние между центрами пропорционально разбросам, так что
+    # он отстоит от обоих центров на одинаковое число разбросов k. Кадр каждой
+    # компоненты попадает по нужную сторону порога с вероятностью Φ(k) —
+    # это и есть уверенность (0.84 при k = 1).
+    mu_open, s_open = _robust(open_values)
+    is_closed = blink_values < mu_open - OPEN_Z * s_open
+    closed = blink_values[is_closed]
+    if len(closed) < MIN_CLOSED_FRAMES or len(closed) == len(blink_values):
+        return None
+    # Во время речи открытые глаза «гуляют» сильнее, чем на неподвижном ролике
+    s_open = max(s_open, _robust(blink_values[~is_closed])[1])
+    mu_closed, s_closed = _robust(closed)
+    threshold = (mu_closed * s_open + mu_open * s_closed) / (s_open + s_closed)
+    k = (mu_open - mu_closed) / (s_open + s_closed)
+    return {
+        'threshold': threshold,
+        'open': mu_open,
+        'closed': mu_closed,
+        'closed_frames': int(len(closed)),
+        'confidence': 0.5 * (1 + math.erf(k / math.sqrt(2))),
+    }
+
+
+def fit_threshold(ear_open, ear_blink):
+    # Возвращает порог, глаз (или оба), по которому его считать, и уверенность.
+    # Плохие ролики отклоняются исключением CalibrationRejected.
+    check_open_clip(ear_open)
+    per_eye = np.ndim(ear_open) == 2 and np.ndim(ear_blink) == 2
+    eyes = ('both', 'left', 'right') if per_eye else ('both',)
+
+    fits = {}
+    for eye in eyes:
+        open_values = _face_frames(_series(ear_open, eye), "видео с открытыми глазами")
+        blink_values = _face_frames(_series(ear_blink, eye), "видео с морганиями")
+        fits[eye] = _fit_eye(open_values, blink_values)
+
+    found = {eye: fit for eye, fit in fits.items() if fit is not None}
+    if not found:
+        raise CalibrationRejected("на видео с морганиями не найдено ни одного моргания")
+    best = max(found, key=lambda eye: found[eye]['confidence'])
+    # Среднее по двум глазам меньше шумит, поэтому один глаз берётся только при
+    # заметной асимметрии (прищур, поворот головы, блик на очках)
+    if 'both' in found and found['both']['confidence'] >= found[best]['confidence'] - BOTH_EYES_MARGIN:
+        best = 'both'
+    fit = found[best]
+    if fit['confidence'] < MIN_CONFIDENCE:
+        raise CalibrationRejected("открытые и закрытые глаза плохо различимы, запишите видео при лучшем освещении")
+
+    asymmetry = None
+    if fits.get('left') and fits.get('right'):
+        asymmetry = abs(fits['left']['threshold'] - fits['right']['threshold'])
+    return {
+        'threshold': fit['threshold'],
+        'eye': best,
+        'confidence': fit['confidence'],
+        'asymmetry': asymmetry,
+        'eyes': fits,
+    }
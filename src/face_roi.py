@@ -0,0 +1,48 @@
+from src.media import crop_i420, i420_to_rgb
+
+# Точки овала лица: лоб, подбородок, скулы, виски, углы челюсти
+FACE_BOX_INDICES = [10, 152, 234, 454, 127, 356, 58, 288]
+
+
+class FaceRoiTracker:
+    # Держит рамку лица с прошлого кадра и подаёт в FaceMesh только её.
+    # Рамка пересчитывается, лишь когда лицо подходит к её краю: частые сдвиги
+    # сбивали бы внутренний трекинг FaceMesh.
+    def __init__(self, pad=0.35, min_size=96):
+        self.pad = pad
+        self.min_size = min_size
+        self.box = None
+
+    def reset(self):
+        self.box = None
+
+    def crop(self, frame, width, height):
+        if self.box is None:
+            return i420_to_rgb(frame), 0, 0
+        x0, y0, _, _ = self.box
+        return i420_to_rgb(crop_i420(frame, width, height, self.box)), x0, y0
+
+    def update(self, landmarks, x0, y0, w, h, width, height):
+        xs = [x0 + landmarks[i].x * w for i in FACE_BOX_INDICES]
+        ys = [y0 + landmarks[i].y * h for i in FACE_BOX_INDICES]
+        fx0, fx1, fy0, fy1 = min(xs), max(xs), min(ys), max(ys)
+
+        if self.box is not None:
+            bx0, by0, bx1, by1 = self.box
+            margin_x = (fx1 - fx0) * self.pad / 2
+            margin_y = (fy1 - fy0) * self.pad / 2
+            if (fx0 - margin_x >= bx0 and fx1 + margin_x <= bx1 and
+                    fy0 - margin_y >= by0 and fy1 + margin_y <= by1):
+                return
+
+        size = max(fx1 - fx0, fy1 - fy0) * (1 + 2 * self.pad)
+        size = max(size, self.min_size)
+        cx, cy = (fx0 + fx1) / 2, (fy0 + fy1) / 2
+        bx0 = max(0, int(cx - size / 2)) & ~1
+        by0 = max(0, int(cy - size / 2)) & ~1
+        bx1 = min(width, int(cx + size / 2) + 1) & ~1
+        by1 = min(height, int(cy + size / 2) + 1) & ~1
+        if bx1 - bx0 < 2 or by1 - by0 < 2 or (bx1 - bx0 >= width and by1 - by0 >= height):
+            self.box = None
+        else:
+            self.box = (bx0, by0, bx1, by1)
@@ -1,34 +1,76 @@
 import numpy as np
 
+# Порядок столбцов матрицы признаков, веса и направление влияния на усталость
+FEATURES = [
+    'blink_rate',
+    'avg_dur',
+    'spectral_centroid_mean',
+    'spectral_flux_mean',
+    'rms_db_mean',
+    'f0_mean_hz',
+    'jitter_percent',
+    'shimmer_db',
+    'speech_rate_wpm',
+]
+WEIGHTS = np.array([0.15, 0.20, 0.05, 0.05, 0.10, 0.10, 0.10, 0.10, 0.15])
+DIRECTIONS = np.array([1, 1, -1, 1, -1, -1, 1, 1, -1])
+# Версия определений признаков: меняется, когда признак начинают считать
+# по-другому (темп речи по ядрам слогов вместо подсчёта слов Google,
+# начало моргания с первого закрытого кадра). Калибровка другой версии с
+# новыми замерами несравнима — её нужно пройти заново. У калибровок без
+# поля FEATURE_VERSION версия 1.
+FEATURE_VERSION = 2
+# Калибровочное значение меньше этого по модулю (например, 0 слов/мин, когда
+# речь не распознана) не даёт опорного уровня — признак в оценку не входит
+MIN_SCALE = 1e-9
+
+
+def calibration_outdated(calibration):
+    return calibration.get('FEATURE_VERSION', 1) != FEATURE_VERSION
+
+
+def feature_row(features):
+    return np.array([features[f] for f in FEATURES], dtype=float)
+
+
+def feature_matrix(rows):
+    # Список словарей признаков -> матрица (N, 9) в порядке FEATURES
+    return np.array([[row[f] for f in FEATURES] for row in rows], dtype=float).reshape(-1, len(FEATURES))
+
+
+def feature_contributions(calibration, current):
+    # calibration, current: (9,) или (N, 9); калибровка — одна на все строки
+    # или своя для каждой. Вклад — относительное отклонение от калибровки со
+    # знаком направления; при нулевой калибровке или NaN вклад равен нулю.
+    calibration = np.asarray(calibration, dtype=float)
+    current = np.asarray(current, dtype=float)
+    diff = DIRECTIONS * (current - calibration)
+    scale = np.abs(calibration)
+    valid = (scale > MIN_SCALE) & np.isfinite(diff)
+    out = np.zeros(np.broadcast_shapes(diff.shape, scale.shape))
+    return np.divide(diff, scale, out=out, where=valid)
+
+
+def fatigue_scores(calibration, current):
+    # Оценки усталости для всех строк одним умножением: (N, 9) -> (N,)
+    return feature_contributions(calibration, current) @ WEIGHTS
+
+
 def calculate_fatigue(calibration, current):
-    params = {
-        'blink_rate': {'weight': 0.15, 'direction': 1},
-        'avg_dur': {'weight': 0.20, 'direction': 1},
-        'spectral_centroid_mean': {'weight': 0.05, 'direction': -1},
-        'spectral_flux_mean': {'weight': 0.05, 'direction': 1},
-        'rms_db_mean': {'weight': 0.10, 'direction': -1},
-        'f0_mean_hz': {'weight': 0.10, 'direction': -1},
-        'jitter_percent': {'weight': 0.10, 'direction': 1},
-        'shimmer_db': {'weight': 0.10, 'direction': 1},
-        'speech_rate_wpm': {'weight': 0.15, 'direction': -1}
-    }
-
-    fatigue_score = 0
-    contributions = {}
-    for param, info in params.items():
-        diff = current[param] - calibration[param]
-        contribution = (info['direction'] * diff) / abs(calibration[param])
-        contributions[param] = contribution
-        fatigue_score += info['weight'] * contribution
-
-
-    return fatigue_score
+    return float(fatigue_scores(feature_row(calibration), feature_row(current)))
 
-def fatigue_to_absolute_kss(fatigue_score, kss_baseline):
 
-    kss_change = fatigue_score * 4
-    absolute_kss = kss_baseline + kss_change
+def fatigue_contributions(calibration, current):
+    # Взвешенный вклад каждого признака в оценку calculate_fatigue
+    weighted = WEIGHTS * feature_contributions(feature_row(calibration), feature_row(current))
+    return dict(zip(FEATURES, weighted.tolist()))
+
+
+def fatigue_to_absolute_kss(fatigue_score, kss_baseline):
+    # Работает и для чисел, и для массивов оценок
+    kss_change = np.asarray(fatigue_score) * 4
+    absolute_kss = np.asarray(kss_baseline) + kss_change
 
-    absolute_kss = round(min(max(1, absolute_kss), 9))
+    absolute_kss = np.rint(np.clip(absolute_kss, 1, 9)).astype(int)
 
-    return absolute_kss
\ No newline at end of file
+    return int(absolute_kss) if absolute_kss.ndim == 0 else absolute_kss
@@ -0,0 +1,212 @@
+import contextvars
+import cProfile
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Настройки берутся из окружения, чтобы spawn-воркеры пула подхватывали их сами
+JSONL_PATH = os.getenv("INSTRUMENT_JSONL")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "profiles"))
+TRACE_MEMORY = os.getenv("INSTRUMENT_TRACEMALLOC") == "1"
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_request = contextvars.ContextVar('request', default=None)
+_jsonl_lock = threading.Lock()
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:12]
+
+
+def _rss_bytes():
+    # Текущий RSS процесса. Где нет /proc (macOS), берётся максимальный RSS:
+    # его прирост за стадию — насколько стадия подняла пик процесса
+    try:
+        with open("/proc/self/statm", 'rb') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux отдаёт килобайты, macOS — байты
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _reset_peak_rss():
+    # Сбрасывает пик RSS (VmHWM) процесса до текущего RSS; есть только в Linux
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_bytes():
+    try:
+        with open("/proc/self/status", 'rb') as f:
+            for line in f:
+                if line.startswith(b"VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+class MetricsRegistry:
+    # Сводка по стадиям для текстового эндпоинта в формате Prometheus
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def observe(self, record):
+        with self._lock:
+            s = self._stages.setdefault(record['stage'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'mem': 0})
+            s['count'] += 1
+            s['wall'] += record['wall_s']
+            s['cpu'] += record['cpu_s'] or 0.0
+            # Последнее значение, а не максимум за всё время: gauge должен и опускаться
+            if record.get('mem_bytes') is not None:
+                s['mem'] = record['mem_bytes']
+
+    def render(self):
+        lines = [
+            "# TYPE neiro_stage_seconds summary",
+            "# TYPE neiro_stage_cpu_seconds_total counter",
+            "# TYPE neiro_stage_memory_bytes gauge",
+        ]
+        with self._lock:
+            for stage, s in sorted(self._stages.items()):
+                label = f'{{stage="{stage}"}}'
+                lines.append(f"neiro_stage_seconds_count{label} {s['count']}")
+                lines.append(f"neiro_stage_seconds_sum{label} {s['wall']:.6f}")
+                lines.append(f"neiro_stage_cpu_seconds_total{label} {s['cpu']:.6f}")
+                lines.append(f"neiro_stage_memory_bytes{label} {s['mem']}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _emit(record):
+    ctx = _request.get()
+    if ctx is not None:
+        ctx['records'].append(record)
+    REGISTRY.observe(record)
+    if JSONL_PATH:
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with _jsonl_lock, open(JSONL_PATH, 'a') as f:
+            f.write(line)
+
+
+def record_stage(name, wall_s, cpu_s=None, mem_bytes=None):
+    # Для стадий, время которых набирается по кадрам (декодирование, FaceMesh, EAR)
+    ctx = _request.get() or {}
+    _emit({
+        'ts': time.time(),
+        'request_id': ctx.get('request_id'),
+        'user_id': ctx.get('user_id'),
+        'pid': os.getpid(),
+        'stage': name,
+        'wall_s': wall_s,
+        'cpu_s': cpu_s,
+        'mem_bytes': mem_bytes,
+    })
+
+
+@contextmanager
+def stage(name):
+    # Память стадии — пик сверх уровня на входе. С INSTRUMENT_TRACEMALLOC=1 —
+    # пик выделений Python/numpy через tracemalloc. Иначе в Linux пик RSS
+    # сбрасывается на входе и на выходе читается VmHWM — так видны и временные
+    # буферы, освобождённые до конца стадии. Пик общий на процесс: вложенная
+    # стадия сбрасывает его и для внешней. Без /proc — прирост RSS за стадию
+    if TRACE_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    peak = False
+    if TRACE_MEMORY:
+        tracemalloc.reset_peak()
+        mem = tracemalloc.get_traced_memory()[0]
+    else:
+        mem = _rss_bytes()
+        peak = _reset_peak_rss()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        if TRACE_MEMORY:
+            mem = tracemalloc.get_traced_memory()[1] - mem
+        else:
+            end = (_peak_rss_bytes() if peak else None) or _rss_bytes()
+            mem = max(0, end - mem)
+        record_stage(name, wall, cpu, mem)
+
+
+@contextmanager
+def request_context(request_id=None, user_id=None):
+    # Все стадии внутри блока помечаются request_id/user_id и собираются в
+    # список, который можно вернуть из процесса-воркера
+    ctx = {'request_id': request_id or new_request_id(), 'user_id': user_id, 'records': []}
+    token = _request.set(ctx)
+    profiler = None
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield ctx
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(PROFILE_DIR / f"{ctx['request_id']}.prof")
+        _request.reset(token)
+
+
+def current_context():
+    ctx = _request.get()
+    if ctx is None:
+        return None
+    return {'request_id': ctx['request_id'], 'user_id': ctx['user_id']}
+
+
+def ingest(records):
+    # Записи из другого процесса: в сводку и в текущий запрос, JSONL они уже
+    # записали сами
+    ctx = _request.get()
+    for record in records:
+        REGISTRY.observe(record)
+        if ctx is not None:
+            ctx['records'].append(record)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
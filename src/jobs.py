@@ -0,0 +1,18 @@
+# Точки входа задач очереди анализа. Конвейер (MediaPipe, OpenCV, librosa,
+# Praat) импортируется только в процессах-воркерах — там его заранее загружает
+# инициализатор пула, — поэтому процесс бота стартует без тяжёлых библиотек.
+
+
+def validate_open_clip(*args, **kwargs):
+    from src.pipeline import validate_open_clip
+    return validate_open_clip(*args, **kwargs)
+
+
+def calibrate_clip(*args, **kwargs):
+    from src.pipeline import calibrate_clip
+    return calibrate_clip(*args, **kwargs)
+
+
+def analyze_clip(*args, **kwargs):
+    from src.pipeline import analyze_clip
+    return analyze_clip(*args, **kwargs)
@@ -0,0 +1,66 @@
+import threading
+import time
+
+
+class LandmarkEngine:
+    # Долгоживущий FaceMesh: граф и модель TFLite собираются один раз и между
+    # видео не перезапускаются
+    def __init__(self, refine_landmarks=True, min_detection_confidence=0.5, min_tracking_confidence=0.5):
+        # MediaPipe загружается при первом создании движка, а не при импорте модуля
+        import mediapipe as mp
+
+        start = time.perf_counter()
+        self._face_mesh = mp.solutions.face_mesh.FaceMesh(
+            static_image_mode=False,
+            max_num_faces=1,
+            refine_landmarks=refine_landmarks,
+            min_detection_confidence=min_detection_confidence,
+            min_tracking_confidence=min_tracking_confidence
+        )
+        self.init_time = time.perf_counter() - start
+        self.reset_time = None
+        self._reset_pending = False
+        self.videos = 0
+        self.frames = 0
+
+    def process(self, rgb):
+        self.frames += 1
+        start = time.perf_counter()
+        results = self._face_mesh.process(rgb)
+        if self._reset_pending:
+            # Граф после reset() поднимается на первом кадре — это часть цены сброса
+            self.reset_time += time.perf_counter() - start
+            self._reset_pending = False
+            print(f"[ENGINE] FaceMesh reset: {self.reset_time * 1000:.0f} ms")
+        if not results.multi_face_landmarks:
+            return None
+        return results.multi_face_landmarks[0].landmark
+
+    def start_video(self):
+        # Лицо нового видео в другом месте кадра FaceMesh находит сам: трекинг
+        # теряет его, и снова запускается детектор
+        self.videos += 1
+
+    def reset(self):
+        # Полный перезапуск графа MediaPipe. Вместе с первым кадром после него
+        # это ~20 мс против 20-40 мс init_time, поэтому между видео не вызывается
+        start = time.perf_counter()
+        self._face_mesh.reset()
+        self.reset_time = time.perf_counter() - start
+        self._reset_pending = True
+
+    def close(self):
+        self._face_mesh.close()
+
+
+_local = threading.local()
+
+
+def get_landmark_engine():
+    # Один движок на поток (в воркерах пула — на процесс)
+    engine = getattr(_local, 'engine', None)
+    if engine is None:
+        engine = LandmarkEngine()
+        _local.engine = engine
+        print(f"[ENGINE] FaceMesh init: {engine.init_time * 1000:.0f} ms")
+    return engine
@@ -0,0 +1,115 @@
+import argparse
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+from src.blink_detector import BlinkDetector
+from src.blinks_analysis import compute_ear_batch, iter_eye_points, select_ear
+from src.media import open_media
+
+
+class CameraSource:
+    # Веб-камера (индекс) или RTSP/HTTP-поток. Отдаёт кадры в I420, как
+    # MediaStream, чтобы работали вырезка лица и общий конвейер EAR.
+    def __init__(self, source=0):
+        self.path = str(source)
+        self._cap = cv2.VideoCapture(source)
+        if not self._cap.isOpened():
+            raise IOError(f"Не удалось открыть источник видео: {source}")
+        self.fps = self._cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.width = int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)) & ~1
+        self.height = int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) & ~1
+        self.timestamp = None
+        self.read_time = None
+
+    def frames(self):
+        start = time.monotonic()
+        while True:
+            ret, frame = self._cap.read()
+            if not ret:
+                break
+            self.read_time = time.perf_counter()
+            self.timestamp = time.monotonic() - start
+            frame = frame[:self.height, :self.width]
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+
+    def close(self):
+        self._cap.release()
+
+
+class ReplaySource:
+    # Проигрывание записанного файла в темпе реального времени (realtime=True)
+    # или как можно быстрее — для отладки живого режима без камеры
+    def __init__(self, video_path, realtime=True):
+        self._media = open_media(video_path, audio=False)
+        self.path = self._media.path
+        self.fps = self._media.fps
+        self.width = self._media.width
+        self.height = self._media.height
+        self.realtime = realtime
+        self.timestamp = None
+        self.read_time = None
+
+    def frames(self):
+        start = time.monotonic()
+        for idx, frame in enumerate(self._media.frames()):
+            self.timestamp = idx / self.fps
+            if self.realtime:
+                delay = start + self.timestamp - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.read_time = time.perf_counter()
+            yield frame
+
+    def close(self):
+        self._media.close()
+
+
+def monitor(source, ear_threshold, consec_frames=2, rate_window_sec=60.0, on_blink=None, eye='both'):
+    # Обрабатывает кадры по мере поступления; задержка считается от получения
+    # кадра до обновления детектора
+    detector = BlinkDetector(ear_threshold, consec_frames, rate_window_sec=rate_window_sec)
+    latencies = deque(maxlen=300)
+
+    def report(duration_ms):
+        rate = detector.blink_rate()
+        latency = float(np.mean(latencies)) if latencies else 0.0
+        if on_blink is not None:
+            on_blink(source.timestamp, duration_ms, rate, latency)
+        else:
+            print(f"[LIVE] t={source.timestamp:.1f}s blink {duration_ms:.0f} ms, "
+                  f"rate {rate:.1f}/min, latency {latency:.1f} ms")
+
+    try:
+        for pts in iter_eye_points(source):
+            duration_ms = detector.update(float(select_ear(compute_ear_batch(pts), eye)), source.timestamp)
+            latencies.append((time.perf_counter() - source.read_time) * 1000.0)
+            if duration_ms is not None:
+                report(duration_ms)
+        # Глаза закрыты в момент окончания записи — моргание закрывается по последнему кадру
+        if source.timestamp is not None:
+            duration_ms = detector.flush(source.timestamp + 1.0 / source.fps)
+            if duration_ms is not None:
+                report(duration_ms)
+    finally:
+        source.close()
+    return detector
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Непрерывный подсчёт морганий с камеры или записи")
+    parser.add_argument("--source", default="0", help="индекс камеры или URL потока (rtsp://...)")
+    parser.add_argument("--replay", help="проиграть видеофайл вместо камеры")
+    parser.add_argument("--fast", action="store_true", help="проигрывать файл без паузы между кадрами")
+    parser.add_argument("--threshold", type=float, required=True, help="порог EAR из калибровки")
+    parser.add_argument("--consec-frames", type=int, default=2)
+    parser.add_argument("--eye", choices=("both", "left", "right"), default="both", help="глаз из калибровки")
+    args = parser.parse_args()
+
+    if args.replay:
+        source = ReplaySource(args.replay, realtime=not args.fast)
+    else:
+        source = CameraSource(int(args.source) if args.source.isdigit() else args.source)
+    monitor(source, args.threshold, args.consec_frames, eye=args.eye)
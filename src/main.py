@@ -1,68 +1,100 @@
 import os
-import json
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures.process import BrokenProcessPool
 # from telegram import Update
 # from telegram.error import TimedOut
 # from telegram.ext import ApplicationBuilder, MessageHandler, filters, ContextTypes, CommandHandler
-from src.blinks_analysis import *
 import telebot
+from telebot import apihelper
 
 from dotenv import load_dotenv
 
 from src.fatigue_calc import *
-from src.sound_analysis import analyze_audio
+from src.analysis_queue import AnalysisQueue, JobTimeout, QueueFull
+from src.calibration_store import open_calibration_store
+from src.ear_cache import EarCache, FeatureStore
+from src.ear_calibration import CalibrationRejected
+from src.instrumentation import ingest, new_request_id, request_context, serve_metrics, stage
+from src.jobs import analyze_clip, calibrate_clip, validate_open_clip
+from src.media_store import MediaRejected, MediaStore
 
 load_dotenv()
 
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 VIDEO_DIR = Path.cwd() / "videos"
+EAR_CACHE = EarCache(VIDEO_DIR / ".ear_cache")
+# Признаки роликов остаются после удаления MP4 по сроку хранения и квотам
+FEATURE_STORE = FeatureStore(VIDEO_DIR / ".features")
+# CALIBRATION_DB=path/to/calibration.sqlite3 — хранить калибровки в SQLite вместо JSON в videos/
+CALIBRATIONS = open_calibration_store(VIDEO_DIR, os.getenv("CALIBRATION_DB"))
+MEDIA_STORE = MediaStore(
+    VIDEO_DIR,
+    max_file_bytes=int(os.getenv("MEDIA_MAX_MB", "20")) * 1024 * 1024,
+    max_duration_sec=int(os.getenv("MEDIA_MAX_DURATION", "90")),
+    retention_days=int(os.getenv("MEDIA_RETENTION_DAYS", "30")),
+    quota_bytes=int(os.getenv("MEDIA_QUOTA_MB", "2048")) * 1024 * 1024,
+    user_quota_bytes=int(os.getenv("MEDIA_USER_QUOTA_MB", "200")) * 1024 * 1024,
+)
+# Голосовая ветка внутри воркера: VOICE_BRANCH=auto|parallel|serial, см. src/pipeline.py
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "2"))
+ANALYSIS_QUEUE_SIZE = int(os.getenv("ANALYSIS_QUEUE_SIZE", "8"))
+ANALYSIS_TIMEOUT = float(os.getenv("ANALYSIS_TIMEOUT", "300"))
+METRICS_PORT = os.getenv("METRICS_PORT")
+# Создаётся в main(): модуль импортируется заново в каждом spawn-воркере
+ANALYSIS_QUEUE = None
 bot = telebot.TeleBot(TOKEN)
 
 def load_user_calibration(user_id: int):
-    calibration_file = VIDEO_DIR / str(user_id) / "calibration_data.json"
-    if not calibration_file.exists():
+    data = CALIBRATIONS.get(user_id)
+    if data is None:
         raise FileNotFoundError("Пользователь не прошёл калибровку")
-    with open(calibration_file, "r") as f:
-        data = json.load(f)
     threshold = data.get("EAR_THRESHOLD")
     fps = data.get("FPS")
     if threshold is None:
         raise KeyError("В calibration_data.json нет поля EAR_THRESHOLD")
-    return threshold, fps
+    # Калибровки до появления EAR_EYE считались по среднему двух глаз
+    return threshold, fps, data.get("EAR_EYE", "both")
 
 def needs_calibration(user_id: int) -> int:
-    calibration_file = f"videos/{user_id}/calibration_data.json"
-    if not os.path.exists(calibration_file):
+    calibration_data = CALIBRATIONS.get(user_id)
+    if calibration_data is None:
         return 0
-    with open(calibration_file, 'r') as f:
-        calibration_data = json.load(f)
-        if calibration_data['first_video']=="None" or calibration_data['KSS_baseline']==0: return 0
-        if calibration_data['second_video']=="None": return 1
-        return 2
+    if calibration_data['first_video']=="None" or calibration_data['KSS_baseline']==0: return 0
+    if calibration_data['second_video']=="None": return 1
+    # Базовая линия посчитана по старым определениям признаков
+    if calibration_outdated(calibration_data): return 0
+    return 2
+
+
+def reset_outdated_calibration(message, user_id):
+    # Завершённая калибровка старой версии удаляется (история остаётся), а
+    # присланный ролик не засчитывается как калибровочный: он записывался для анализа
+    calibration_data = CALIBRATIONS.get(user_id)
+    if calibration_data is None or calibration_data['second_video'] == "None":
+        return False
+    if not calibration_outdated(calibration_data):
+        return False
+    CALIBRATIONS.delete(user_id)
+    bot.send_message(message.chat.id,
+        "Методика анализа обновилась, и ваша калибровка больше не подходит. Пройдите калибровку заново: "
+        "отправьте калибровочное видео — нужно смотреть в камеру 5-10 секунд, не моргая.")
+    return True
 
 @bot.message_handler(func=lambda message: message.text.isdigit() and 1 <= int(message.text) <= 9)
 def handle_kss_input(message):
     user_id = message.from_user.id
-    user_dir = os.path.join(VIDEO_DIR, str(user_id))
-    calibration_file = os.path.join(user_dir, "calibration_data.json")
 
-    if not os.path.exists(calibration_file):
+    try:
+        with CALIBRATIONS.edit(user_id) as calibration_data:
+            if calibration_data.get('KSS_baseline') != 0:
+                bot.send_message(message.chat.id, "Вы уже указали оценку KSS. Теперь отправьте второе калибровочное видео.")
+                return
+            calibration_data['KSS_baseline'] = int(message.text)
+    except FileNotFoundError:
         bot.send_message(message.chat.id, "Вы ещё не начали калибровку. Отправьте сначала первое видео.")
         return
 
-    with open(calibration_file, 'r') as f:
-        calibration_data = json.load(f)
-
-    if calibration_data.get('KSS_baseline') is not 0:
-        bot.send_message(message.chat.id, "Вы уже указали оценку KSS. Теперь отправьте второе калибровочное видео.")
-        return
-
-    calibration_data['KSS_baseline'] = int(message.text)
-
-    with open(calibration_file, 'w') as f:
-        json.dump(calibration_data, f, indent=4)
-
     bot.send_message(message.chat.id,
         f"Спасибо! Ваша оценка по KSS ({message.text}) сохранена. "
         "Теперь отправьте второе калибровочное видео: проговорите текст на протяжении 15-20 секунд.")
@@ -71,19 +103,26 @@ def handle_kss_input(message):
 def handle_video_note(message):
     user_id = message.from_user.id
     user_dir = os.path.join(VIDEO_DIR, str(user_id))
+    # Один request_id на видео: загрузка, воркер и оценка попадают в одну трассу
+    request = {'request_id': new_request_id(), 'user_id': user_id}
+    if reset_outdated_calibration(message, user_id):
+        return
     needs = needs_calibration(user_id)
-    if needs_calibration(user_id)<2:
+    video_note = message.video_note
+    try:
+        MEDIA_STORE.check(video_note.duration, video_note.file_size)
+    except MediaRejected as e:
+        bot.send_message(message.chat.id, f"Видео не принято: {e}. Запишите кружок ещё раз.")
+        return
+
+    if needs<2:
         if not os.path.exists(user_dir):
             os.makedirs(user_dir)
 
-        video = message.video_note
-        file = bot.get_file(video.file_id)
-        calibration_file = os.path.join(user_dir,"calibration_data.json")
         if needs==0:
-            file_path = os.path.join(user_dir,"calibration_open.mp4")
-            downloaded_bytes = bot.download_file(file.file_path)
-            with open(file_path, 'wb') as f:
-                f.write(downloaded_bytes)
+            file_path = download_video(message, os.path.join(user_dir,"calibration_open.mp4"), request, dedupe=False)
+            if file_path is None:
+                return
             calibration_data = {
                 'first_video': file_path,
                 'second_video': "None",
@@ -100,118 +139,161 @@ def handle_video_note(message):
                 'shimmer_db': 0,
                 'speech_rate_wpm': 0
             }
-            with open(calibration_file, 'w+') as f:
-                json.dump(calibration_data, f, indent=4)
+            CALIBRATIONS.save(user_id, calibration_data)
             bot.send_message(
                 message.chat.id,
                 "Первый этап калибровки завершён. Теперь отправьте мне сообщение с числом от 1 до 9, "
                 "соответствующим вашему текущему состоянию по шкале Karolinska Sleepiness Scale "
                 "(1 — очень бодр, 9 — очень сонлив)."
             )
+            # Пока пользователь выбирает оценку KSS, ролик проверяется в очереди:
+            # непригодное видео отклоняется сразу, а не после второго этапа
+            try:
+                ANALYSIS_QUEUE.submit(validate_open_clip, file_path, EAR_CACHE, context=request,
+                                      on_done=lambda future: finish_open_check(message, user_id, future))
+            except (QueueFull, BrokenProcessPool):
+                pass
             #bot.send_message(message.chat.id,f"Первый этап калибровки завершён. Отправьте мне ещё один кружок: проговорите текст на протяжении 15-20 секунд")
         else:
-            file_path = os.path.join(user_dir, "calibration_blink.mp4")
+            file_path = download_video(message, os.path.join(user_dir, "calibration_blink.mp4"), request, dedupe=False)
             print(file_path)
-            bot.send_message(message.chat.id,f"Ожидайте. Финальный этап калибровки займёт некоторое время.")
-
-
-            with open(calibration_file, 'r') as f:
-                calibration_data = json.load(f)
-                print(calibration_data)
-
-            downloaded_bytes = bot.download_file(file.file_path)
-            with open(file_path, 'wb') as f:
-                f.write(downloaded_bytes)
-            ear_threshold, fps = calibrate_threshold(os.path.join(user_dir, f"calibration_open.mp4"), os.path.join(user_dir, f"calibration_blink.mp4"))
-            calibration_data['EAR_THRESHOLD'] = ear_threshold
-            blink_count, blink_rate, avg_dur = analyze_video(file_path, ear_threshold, fps)
-            calibration_data['second_video'] = file_path
-            # calibration_data['blink_count'] = blink_count
-            calibration_data['blink_rate'] = blink_rate
-            calibration_data['avg_dur'] = avg_dur
-            calibration_data['FPS'] = fps
-            features = analyze_audio(os.path.join(user_dir, f"calibration_blink.mp4"))
-            calibration_data['spectral_centroid_mean'] = features['spectral_centroid_mean']
-            calibration_data['spectral_flux_mean'] = features['spectral_flux_mean']
-            calibration_data['rms_db_mean'] = features['rms_db_mean']
-            calibration_data['f0_mean_hz'] = features['f0_mean_hz']
-            calibration_data['jitter_percent'] = features['jitter_percent']
-            calibration_data['shimmer_db'] = features['shimmer_db']
-            calibration_data['speech_rate_wpm'] = features['speech_rate_wpm']
-            with open(calibration_file, 'w+') as f:
-                json.dump(calibration_data, f, indent=4)
-            bot.send_message(message.chat.id,f"Калибровка успешна. Теперь вы можете отправлять видео для проверки")
+            if file_path is None:
+                return
+            submit_job(
+                message, "Ожидайте. Финальный этап калибровки займёт некоторое время.",
+                calibrate_clip, os.path.join(user_dir, f"calibration_open.mp4"), file_path, EAR_CACHE,
+                on_done=lambda future: finish_calibration(message, user_id, file_path, future),
+                context=request
+            )
         return
 
 
     if not os.path.exists(user_dir):
         os.makedirs(user_dir)
 
-    video_note = message.video_note
-    file = bot.get_file(video_note.file_id)
-
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    file_path = os.path.join(user_dir, f"{timestamp}.mp4")
+    # Повторно присланный ролик не сохраняется второй раз, а EAR для него берётся из кэша
+    file_path = download_video(message, os.path.join(user_dir, f"{timestamp}.mp4"), request)
+    if file_path is None:
+        return
 
-    downloaded_bytes = bot.download_file(file.file_path)
-    with open(file_path, 'wb') as f:
-        f.write(downloaded_bytes)
+    ear_threshold, fps, eye = load_user_calibration(user_id)
+    submit_job(
+        message, "Видео получено и сохранено. Анализ поставлен в очередь...",
+        analyze_clip, file_path, ear_threshold, fps, EAR_CACHE, eye=eye, feature_store=FEATURE_STORE,
+        on_done=lambda future: finish_analysis(message, request, future),
+        context=request
+    )
 
-    bot.send_message(message.chat.id,"Видео получено и сохранено. Начинаю анализ...")
 
-    ear_threshold, fps = load_user_calibration(user_id)
-    blink_count, blink_rate, avg_dur = analyze_video(file_path, ear_threshold, fps)
-    features = analyze_audio(file_path)
+def download_video(message, file_path, request, dedupe=True):
+    # Файл пишется на диск по частям, не целиком в память. None — загрузка не удалась
+    video_note = message.video_note
+    try:
+        with request_context(**request), stage('download'):
+            file = bot.get_file(video_note.file_id)
+            url = (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(TOKEN, file.file_path)
+            # Прокси из настроек telebot, как у bot.download_file
+            return str(MEDIA_STORE.fetch(url, file_path, video_note.file_unique_id, dedupe=dedupe,
+                                         proxies=apihelper.proxy))
+    except MediaRejected as e:
+        bot.send_message(message.chat.id, f"Видео не принято: {e}. Запишите кружок ещё раз.")
+    except Exception as e:
+        # В URL загрузки есть токен бота, а requests пишет URL в текст ошибки
+        print(f"[DOWNLOAD] {type(e).__name__}: {redact_token(e)}")
+        bot.send_message(message.chat.id, "Не удалось загрузить видео. Попробуйте отправить его ещё раз.")
+    return None
+
+
+def redact_token(e):
+    text = str(e)
+    return text.replace(TOKEN, "<token>") if TOKEN else text
+
+
+def submit_job(message, ack, fn, *args, on_done, context=None):
+    try:
+        ANALYSIS_QUEUE.submit(fn, *args, on_done=on_done, context=context)
+    except QueueFull:
+        bot.send_message(message.chat.id, "Очередь анализа переполнена, попробуйте отправить видео чуть позже.")
+        return False
+    except BrokenProcessPool as e:
+        # Пул не поднялся и после перезапуска
+        print(f"[QUEUE] {type(e).__name__}: {e}")
+        bot.send_message(message.chat.id, "Анализ временно недоступен, попробуйте отправить видео чуть позже.")
+        return False
+    bot.send_message(message.chat.id, ack)
+    return True
+
+
+def job_result(message, future):
+    try:
+        return future.result()
+    except JobTimeout:
+        bot.send_message(message.chat.id, "Анализ занял слишком много времени и был остановлен. Попробуйте записать видео ещё раз.")
+    except CalibrationRejected as e:
+        bot.send_message(message.chat.id,
+            f"Калибровочное видео не подошло: {e}. Отправьте второе калибровочное видео ещё раз. "
+            "Если дело в видео с открытыми глазами, начните заново командой /recalibrate.")
+    except Exception as e:
+        print(f"[JOB] {type(e).__name__}: {e}")
+        bot.send_message(message.chat.id, "Не удалось обработать видео. Попробуйте записать его ещё раз.")
+    return None
+
+
+def finish_open_check(message, user_id, future):
+    try:
+        ingest(future.result().pop('stages', []))
+    except CalibrationRejected as e:
+        CALIBRATIONS.delete(user_id)
+        bot.send_message(message.chat.id,
+            f"Первое калибровочное видео не подошло: {e}. Отправьте его заново: "
+            "нужно смотреть в камеру 5-10 секунд, не моргая.")
+    except Exception as e:
+        # Проверка необязательна: финальный этап калибровки всё равно её повторит
+        print(f"[JOB] {type(e).__name__}: {e}")
+
+
+def finish_calibration(message, user_id, file_path, future):
+    result = job_result(message, future)
+    if result is None:
+        return
+    result.pop('timings', None)
+    ingest(result.pop('stages', []))
+    try:
+        with CALIBRATIONS.edit(user_id) as calibration_data:
+            calibration_data.update(result)
+            calibration_data['second_video'] = file_path
+            calibration_data['FEATURE_VERSION'] = FEATURE_VERSION
+    except FileNotFoundError:
+        # Пока шёл анализ, пользователь запустил /recalibrate
+        return
+    CALIBRATIONS.add_history(user_id, 'calibration', calibration_data)
+    bot.send_message(message.chat.id,f"Калибровка успешна. Теперь вы можете отправлять видео для проверки")
+
+
+def finish_analysis(message, request, future):
+    current = job_result(message, future)
+    if current is None:
+        return
+    user_id = request['user_id']
+    with request_context(**request):
+        ingest(current.pop('stages', []))
+        with stage('scoring'):
+            absolute_kss, fatigue = score_clip(user_id, current)
     tts = (f"Полученные результаты:\n"
         f"Видеоанализ:\n"
-        f"blink_rate = {blink_rate}\n"
-        f"avg_dur = {avg_dur}\n\n"
+        f"blink_rate = {current['blink_rate']}\n"
+        f"avg_dur = {current['avg_dur']}\n\n"
         f"Аудиоанализ:\n"
-        f"spectral_centroid_mean = {features['spectral_centroid_mean']}\n"
-        f"spectral_flux_mean = {features['spectral_flux_mean']}\n"
-        f"rms_db_mean = {features['rms_db_mean']}\n"
-        f"f0_mean_hz = {features['f0_mean_hz']}\n"
-        f"jitter_percent = {features['jitter_percent']}\n"
-        f"shimmer_db = {features['shimmer_db']}\n"
-        f"speech_rate_wpm = {features['speech_rate_wpm']}")
+        f"spectral_centroid_mean = {current['spectral_centroid_mean']}\n"
+        f"spectral_flux_mean = {current['spectral_flux_mean']}\n"
+        f"rms_db_mean = {current['rms_db_mean']}\n"
+        f"f0_mean_hz = {current['f0_mean_hz']}\n"
+        f"jitter_percent = {current['jitter_percent']}\n"
+        f"shimmer_db = {current['shimmer_db']}\n"
+        f"speech_rate_wpm = {current['speech_rate_wpm']}")
     #bot.send_message(message.chat.id,tts)
 
-    print('Вычисление усталости, где 1 - абсолютная усталость')
-
-    calibration_file = os.path.join(VIDEO_DIR, str(user_id), "calibration_data.json")
-    with open(calibration_file, 'r') as f:
-        calibration_json = json.load(f)
-
-    calibration = {
-        'blink_rate': calibration_json['blink_rate'],
-        'avg_dur': calibration_json['avg_dur'],
-        'FPS': calibration_json['FPS'],
-        'spectral_centroid_mean': calibration_json['spectral_centroid_mean'],
-        'spectral_flux_mean': calibration_json['spectral_flux_mean'],
-        'rms_db_mean': calibration_json['rms_db_mean'],
-        'f0_mean_hz': calibration_json['f0_mean_hz'],
-        'jitter_percent': calibration_json['jitter_percent'],
-        'shimmer_db': calibration_json['shimmer_db'],
-        'speech_rate_wpm': calibration_json['speech_rate_wpm']
-    }
-
-    current = {
-        'blink_rate': blink_rate,
-        'avg_dur': avg_dur,
-        'FPS': fps,
-        'spectral_centroid_mean': features['spectral_centroid_mean'],
-        'spectral_flux_mean': features['spectral_flux_mean'],
-        'rms_db_mean': features['rms_db_mean'],
-        'f0_mean_hz': features['f0_mean_hz'],
-        'jitter_percent': features['jitter_percent'],
-        'shimmer_db': features['shimmer_db'],
-        'speech_rate_wpm': features['speech_rate_wpm']
-    }
-
-    # print(f"Ваша степень усталости - {calculate_fatigue(calibration, current)}")
-    fatigue = calculate_fatigue(calibration, current)
-    absolute_kss = fatigue_to_absolute_kss(fatigue, calibration_json['KSS_baseline'])
-
     kss_descriptions = {
         1: "Очень бодр и внимателен",
         2: "Хорошо бодр и внимателен",
@@ -232,15 +314,48 @@ def handle_video_note(message):
 
     # bot.send_message(message.chat.id,f"Полученные результаты:\n blink_count = {blink_count} \n blink_rate = {blink_rate} \n avg_dur = {avg_dur}")
 
+
+def score_clip(user_id, current):
+    print('Вычисление усталости, где 1 - абсолютная усталость')
+
+    calibration_json = CALIBRATIONS.get(user_id)
+    if calibration_json is None:
+        raise FileNotFoundError("Пользователь не прошёл калибровку")
+
+    calibration = {
+        'blink_rate': calibration_json['blink_rate'],
+        'avg_dur': calibration_json['avg_dur'],
+        'FPS': calibration_json['FPS'],
+        'spectral_centroid_mean': calibration_json['spectral_centroid_mean'],
+        'spectral_flux_mean': calibration_json['spectral_flux_mean'],
+        'rms_db_mean': calibration_json['rms_db_mean'],
+        'f0_mean_hz': calibration_json['f0_mean_hz'],
+        'jitter_percent': calibration_json['jitter_percent'],
+        'shimmer_db': calibration_json['shimmer_db'],
+        'speech_rate_wpm': calibration_json['speech_rate_wpm']
+    }
+
+    # print(f"Ваша степень усталости - {calculate_fatigue(calibration, current)}")
+    fatigue = calculate_fatigue(calibration, current)
+    absolute_kss = fatigue_to_absolute_kss(fatigue, calibration_json['KSS_baseline'])
+    CALIBRATIONS.add_history(user_id, 'score', {
+        **current,
+        'fatigue': fatigue,
+        'kss': absolute_kss,
+        'contributions': fatigue_contributions(calibration, current),
+    })
+    return absolute_kss, fatigue
+
 @bot.message_handler(commands=['recalibrate'])
 def recalibrate(message):
     user_id = message.from_user.id
 
     if needs_calibration(user_id)>0:
         bot.send_message(message.chat.id,"Калибровка уже проводилась. Начнём заново: отправь два калибровочных видео")
-        calibration_file = f"videos/{user_id}/calibration_data.json"
-        os.remove(calibration_file)
+        CALIBRATIONS.delete(user_id)
     else:
+        # Устаревшая калибровка (см. needs_calibration) тоже сбрасывается
+        CALIBRATIONS.delete(user_id)
         bot.send_message(message.chat.id,"Первичный запуск калибровки... Пожалуйста, отправьте калибровочное видео: нужно смотреть в камеру 5-10 секунд, не моргая.")
 
 
@@ -252,8 +367,16 @@ def main():
     #
     #
     # app.add_handler(CommandHandler("recalibrate", recalibrate))
+    global ANALYSIS_QUEUE
+    ANALYSIS_QUEUE = AnalysisQueue(ANALYSIS_WORKERS, ANALYSIS_QUEUE_SIZE, ANALYSIS_TIMEOUT)
+    if METRICS_PORT:
+        # Сводка по стадиям в формате Prometheus: http://127.0.0.1:<port>/metrics
+        serve_metrics(int(METRICS_PORT))
     print("Бот запущен!")
-    bot.polling()
+    try:
+        bot.polling()
+    finally:
+        ANALYSIS_QUEUE.shutdown(wait=False)
 
 
 
@@ -0,0 +1,262 @@
+import os
+import subprocess
+import threading
+
+import cv2
+import numpy as np
+
+
+class MediaStream:
+    # Один процесс ffmpeg на файл: видео идёт в stdout как yuv4mpeg (размер и
+    # fps приходят в заголовке потока), моно PCM float32 — в отдельный pipe.
+    # audio_filter (например, BandpassStream) применяется к PCM кусками по мере
+    # чтения, параллельно с обработкой кадров.
+    def __init__(self, video_path, sr_target=22050, video=True, audio=True, audio_filter=None):
+        if not os.path.exists(video_path):
+            raise FileNotFoundError(f"Видео-файл не найден: {video_path}")
+        if not video and not audio:
+            raise ValueError("Нужно запросить хотя бы один поток: video или audio")
+
+        self.path = str(video_path)
+        self.sr = sr_target
+        self.width = 0
+        self.height = 0
+        self.fps = 0.0
+        self.frame_count = 0
+        self._has_video = video
+        self._frames_done = not video
+        self._audio_chunks = []
+        self._audio_filter = audio_filter
+        self._stderr = b""
+
+        cmd = ["ffmpeg", "-nostdin", "-v", "error", "-i", self.path]
+        pass_fds = ()
+        audio_read_fd = None
+        if video:
+            cmd += [
+                "-map", "0:v:0",
+                # Кадры как есть, без дублирования под постоянный fps: у роликов с
+                # переменной частотой время кадров берётся из timestamps()
+                "-vsync", "passthrough",
+                "-vf", "crop=trunc(iw/2)*2:trunc(ih/2)*2",
+                "-pix_fmt", "yuv420p",
+                "-f", "yuv4mpegpipe",
+                "pipe:1",
+            ]
+        if audio:
+            if video:
+                audio_read_fd, audio_write_fd = os.pipe()
+                pass_fds = (audio_write_fd,)
+                target = f"pipe:{audio_write_fd}"
+            else:
+                target = "pipe:1"
+            cmd += [
+                "-map", "0:a:0",
+                "-ac", "1",
+                "-ar", str(sr_target),
+                "-f", "f32le",
+                target,
+            ]
+
+        self._proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            pass_fds=pass_fds,
+        )
+        if pass_fds:
+            os.close(pass_fds[0])
+
+        self._threads = [threading.Thread(target=self._read_stderr, daemon=True)]
+        if audio:
+            audio_file = os.fdopen(audio_read_fd, "rb") if video else self._proc.stdout
+            self._threads.append(threading.Thread(target=self._read_audio, args=(audio_file,), daemon=True))
+        for t in self._threads:
+            t.start()
+
+        if video:
+            self._read_y4m_header()
+
+    def _read_stderr(self):
+        self._stderr = self._proc.stderr.read()
+
+    def _read_audio(self, f):
+        tail = b""
+        with f:
+            while True:
+                chunk = f.read(1 << 16)
+                if not chunk:
+                    break
+                if self._audio_filter is None:
+                    self._audio_chunks.append(chunk)
+                    continue
+                # Из pipe может прийти неполный отсчёт — остаток ждёт следующего куска
+                chunk = tail + chunk
+                usable = len(chunk) // 4 * 4
+                tail = chunk[usable:]
+                self._audio_chunks.append(self._audio_filter(np.frombuffer(chunk[:usable], dtype=np.float32)))
+
+    def _read_y4m_header(self):
+        header = self._proc.stdout.readline()
+        if not header.startswith(b"YUV4MPEG2"):
+            self._finish()
+            raise RuntimeError(f"FFmpeg error:\n{self._stderr.decode('utf-8', 'replace')}")
+        for token in header.split()[1:]:
+            key, value = token[:1], token[1:].decode()
+            if key == b"W":
+                self.width = int(value)
+            elif key == b"H":
+                self.height = int(value)
+            elif key == b"F":
+                num, den = value.split(":")
+                self.fps = int(num) / int(den) if int(den) else 0.0
+        self.fps = self.fps or 30.0
+
+    def frames(self):
+        # Кадры в I420: массив (h * 3 // 2, w) uint8, см. i420_to_rgb
+        if self._frames_done:
+            return
+        frame_size = self.width * self.height * 3 // 2
+        stdout = self._proc.stdout
+        try:
+            while True:
+                if not stdout.readline():
+                    break
+                buf = stdout.read(frame_size)
+                if len(buf) < frame_size:
+                    break
+                self.frame_count += 1
+                yield np.frombuffer(buf, dtype=np.uint8).reshape(self.height * 3 // 2, self.width)
+        finally:
+            self._frames_done = True
+
+    def timestamps(self):
+        # Время показа выданных кадров в секундах от первого. Если его не удалось
+        # сопоставить с кадрами (нет ffprobe, пакеты без pts) — равномерная сетка по fps
+        t = frame_timestamps(self.path) if self._has_video else None
+        if t is None or len(t) != self.frame_count:
+            return np.arange(self.frame_count) / self.fps
+        return t
+
+    def audio(self):
+        if self._has_video and not self._frames_done:
+            for _ in self.frames():
+                pass
+        self._finish()
+        if self._proc.returncode != 0:
+            raise RuntimeError(f"FFmpeg error:\n{self._stderr.decode('utf-8', 'replace')}")
+        if self._audio_filter is None:
+            y = np.frombuffer(b"".join(self._audio_chunks), dtype=np.float32)
+        else:
+            y = np.concatenate(self._audio_chunks) if self._audio_chunks else np.zeros(0, dtype=np.float32)
+        self._audio_chunks = []
+        return y, self.sr
+
+    def _finish(self):
+        if self._has_video:
+            self._proc.stdout.close()
+        self._proc.wait()
+        for t in self._threads:
+            t.join()
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._frames_done = True
+        self._finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_media(video_path, sr_target=22050, video=True, audio=True, audio_filter=None):
+    return MediaStream(video_path, sr_target=sr_target, video=video, audio=audio, audio_filter=audio_filter)
+
+
+def frame_timestamps(video_path):
+    # pts кадров видеопотока по пакетам: ffprobe только читает контейнер, без
+    # декодирования. None, если у какого-то пакета нет времени.
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time",
+        "-of", "csv=p=0",
+        str(video_path),
+    ]
+    try:
+        out = subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    try:
+        t = np.array([float(line.strip(b",")) for line in out.split()])
+    except ValueError:
+        return None
+    if not len(t):
+        return None
+    # Пакеты идут в порядке декодирования, с B-кадрами он не совпадает с порядком показа
+    t.sort()
+    return t - t[0]
+
+
+def average_fps(timestamps, fallback):
+    # Средняя частота по реальным временам кадров: для ролика с переменной
+    # частотой число кадров / fps из заголовка не равно длительности
+    if len(timestamps) < 2 or timestamps[-1] <= 0:
+        return fallback
+    return (len(timestamps) - 1) / float(timestamps[-1])
+
+
+def i420_to_rgb(frame):
+    return cv2.cvtColor(frame, cv2.COLOR_YUV2RGB_I420)
+
+
+def crop_i420(frame, width, height, box):
+    # Вырезает box = (x0, y0, x1, y1) из кадра I420 без перевода в RGB.
+    # Координаты должны быть чётными, чтобы не сдвигать цветовые плоскости.
+    x0, y0, x1, y1 = box
+    cw, ch = x1 - x0, y1 - y0
+    flat = frame.reshape(-1)
+    plane = width * height
+    y_plane = flat[:plane].reshape(height, width)
+    u_plane = flat[plane:plane + plane // 4].reshape(height // 2, width // 2)
+    v_plane = flat[plane + plane // 4:].reshape(height // 2, width // 2)
+
+    out = np.empty(ch * cw * 3 // 2, dtype=np.uint8)
+    crop_plane = cw * ch
+    out[:crop_plane].reshape(ch, cw)[:] = y_plane[y0:y1, x0:x1]
+    out[crop_plane:crop_plane + crop_plane // 4].reshape(ch // 2, cw // 2)[:] = u_plane[y0 // 2:y1 // 2, x0 // 2:x1 // 2]
+    out[crop_plane + crop_plane // 4:].reshape(ch // 2, cw // 2)[:] = v_plane[y0 // 2:y1 // 2, x0 // 2:x1 // 2]
+    return out.reshape(ch * 3 // 2, cw)
+
+
+def iter_audio_chunks(video_path, sr_target=22050, chunk_sec=10.0):
+    # Звук кусками по chunk_sec секунд прямо из pipe ffmpeg: для длинных записей
+    # в памяти не держится вся волна
+    if not os.path.exists(video_path):
+        raise FileNotFoundError(f"Видео-файл не найден: {video_path}")
+    cmd = [
+        "ffmpeg", "-nostdin", "-v", "error",
+        "-i", str(video_path),
+        "-vn",
+        "-ac", "1",
+        "-ar", str(sr_target),
+        "-f", "f32le",
+        "pipe:1",
+    ]
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    chunk_bytes = int(chunk_sec * sr_target) * 4
+    try:
+        while True:
+            buf = proc.stdout.read(chunk_bytes)
+            if len(buf) < 4:
+                break
+            yield np.frombuffer(buf[:len(buf) // 4 * 4], dtype=np.float32)
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
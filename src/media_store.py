@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import requests
+
+INDEX_FILE = ".media_index.json"
+PARTIAL_DIR = ".partial"
+CHUNK_SIZE = 1 << 16
+# Ролики моложе этого возраста не удаляются: они могут ждать анализа в очереди
+MIN_EVICT_AGE_SEC = 3600
+
+
+class MediaRejected(ValueError):
+    pass
+
+
+class MediaStore:
+    # Хранилище видео пользователей: videos/<user_id>/*.mp4.
+    # Загрузка идёт потоком на диск кусками, недокачанный файл
+    # (.partial/<file_unique_id>.part) докачивается с места обрыва. Одинаковые
+    # ролики одного пользователя хранятся один раз. Сырые MP4 удаляются по
+    # сроку хранения и квотам; записи индекса (пользователь/хэш -> имя файла)
+    # остаются, и по хэшу находятся сохранённые признаки ролика (FeatureStore).
+    def __init__(self, root, max_file_bytes=20 * 1024 * 1024, min_duration_sec=1, max_duration_sec=90,
+                 retention_days=30, quota_bytes=2 * 1024 ** 3, user_quota_bytes=200 * 1024 * 1024,
+                 keep_calibration=True, enforce_interval_sec=600):
+        self.root = Path(root)
+        self.max_file_bytes = max_file_bytes
+        self.min_duration_sec = min_duration_sec
+        self.max_duration_sec = max_duration_sec
+        self.retention_days = retention_days
+        self.quota_bytes = quota_bytes
+        self.user_quota_bytes = user_quota_bytes
+        self.keep_calibration = keep_calibration
+        self.enforce_interval_sec = enforce_interval_sec
+        self._lock = threading.Lock()
+        self._partial_locks = {}
+        self._last_enforce = 0.0
+
+    def check(self, duration_sec=None, size_bytes=None):
+        # По метаданным Telegram, до загрузки и любого анализа
+        if size_bytes is not None and size_bytes > self.max_file_bytes:
+            raise MediaRejected(f"видео больше {self.max_file_bytes // (1024 * 1024)} МБ")
+        if duration_sec is not None and duration_sec < self.min_duration_sec:
+            raise MediaRejected("видео слишком короткое")
+        if duration_sec is not None and duration_sec > self.max_duration_sec:
+            raise MediaRejected(f"видео длиннее {self.max_duration_sec} секунд")
+
+    def fetch(self, url, dest, partial_key, dedupe=True, retries=3, proxies=None):
+        # Возвращает путь к сохранённому ролику: dest или уже лежащий рядом
+        # ролик с тем же содержимым (при dedupe=True). proxies — как в requests
+        dest = Path(dest)
+        partial = self.root / PARTIAL_DIR / f"{partial_key}.part"
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        # Обработчики бота работают в потоках: один и тот же ролик, присланный
+        # дважды подряд, не должен дописываться в один .part из двух потоков
+        with self._partial_lock(partial_key):
+            for attempt in range(retries + 1):
+                try:
+                    digest = self._download(url, partial, proxies)
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                    if attempt == retries:
+                        raise
+                    time.sleep(2 ** attempt)
+            path = self._commit(partial, dest, digest, dedupe)
+        self.maybe_enforce()
+        return path
+
+    @contextmanager
+    def _partial_lock(self, partial_key):
+        # Блокировка на file_unique_id; удаляется, когда её никто не ждёт
+        with self._lock:
+            entry = self._partial_locks.setdefault(partial_key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._partial_locks[partial_key]
+
+    def _commit(self, partial, dest, digest, dedupe):
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            index = self._load_index()
+            key = f"{dest.parent.name}/{digest}"
+            existing = dest.parent / index.get(key, "")
+            if dedupe and key in index and existing.is_file() and existing != dest:
+                partial.unlink()
+                # Свежая отметка времени, чтобы ролик не удалили, пока он ждёт анализа
+                os.utime(existing)
+                return existing
+            os.replace(partial, dest)
+            index[key] = dest.name
+            self._save_index(index)
+        return dest
+
+    def _download(self, url, partial, proxies=None):
+        # Докачка через Range: если сервер отдал весь файл заново (200), пишем с нуля
+        h = hashlib.sha256()
+        offset = partial.stat().st_size if partial.exists() else 0
+        headers = {'Range': f"bytes={offset}-"} if offset else {}
+        with requests.get(url, headers=headers, stream=True, timeout=30, proxies=proxies) as response:
+            if response.status_code == 416:
+                # Недокачанный файл длиннее ролика на сервере — качаем заново
+                partial.unlink()
+                return self._download(url, partial, proxies)
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            total = response.headers.get('Content-Length')
+            if total is not None and offset + int(total) > self.max_file_bytes:
+                partial.unlink(missing_ok=True)
+                raise MediaRejected(f"видео больше {self.max_file_bytes // (1024 * 1024)} МБ")
+
+            if offset:
+                with open(partial, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        h.update(chunk)
+            size = offset
+            with open(partial, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_file_bytes:
+                        f.close()
+                        partial.unlink()
+                        raise MediaRejected(f"видео больше {self.max_file_bytes // (1024 * 1024)} МБ")
+                    h.update(chunk)
+                    f.write(chunk)
+        return h.hexdigest()
+
+    def clips(self):
+        # Все ролики из индекса, в том числе уже удалённые: (user_id, путь, хэш)
+        with self._lock:
+            index = self._load_index()
+        clips = []
+        for key, name in index.items():
+            user_id, digest = key.split('/', 1)
+            clips.append((user_id, self.root / user_id / name, digest))
+        return clips
+
+    def _load_index(self):
+        try:
+            with open(self.root / INDEX_FILE, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_index(self, index):
+        path = self.root / INDEX_FILE
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, path)
+
+    def maybe_enforce(self):
+        now = time.time()
+        if now - self._last_enforce < self.enforce_interval_sec:
+            return
+        self._last_enforce = now
+        self.enforce(now)
+
+    def enforce(self, now=None):
+        # Срок хранения, затем квота на пользователя, затем общая — удаляются
+        # самые старые ролики. Возвращает число удалённых файлов.
+        now = time.time() if now is None else now
+        clips = []
+        for user_dir in self.root.iterdir():
+            if not user_dir.is_dir() or user_dir.name.startswith('.'):
+                continue
+            for clip in user_dir.glob("*.mp4"):
+                if self.keep_calibration and clip.name.startswith("calibration_"):
+                    continue
+                try:
+                    st = clip.stat()
+                except FileNotFoundError:
+                    continue
+                if now - st.st_mtime >= MIN_EVICT_AGE_SEC:
+                    clips.append((st.st_mtime, st.st_size, user_dir.name, clip))
+        clips.sort()
+
+        removed = set()
+        if self.retention_days is not None:
+            removed.update(c for c in clips if now - c[0] > self.retention_days * 86400)
+
+        if self.user_quota_bytes is not None:
+            per_user = {}
+            for c in clips:
+                if c not in removed:
+                    per_user.setdefault(c[2], []).append(c)
+            for user_clips in per_user.values():
+                used = sum(c[1] for c in user_clips)
+                for c in user_clips:
+                    if used <= self.user_quota_bytes:
+                        break
+                    removed.add(c)
+                    used -= c[1]
+
+        if self.quota_bytes is not None:
+            remaining = [c for c in clips if c not in removed]
+            used = sum(c[1] for c in remaining)
+            for c in remaining:
+                if used <= self.quota_bytes:
+                    break
+                removed.add(c)
+                used -= c[1]
+
+        for _, _, _, clip in removed:
+            try:
+                clip.unlink()
+            except FileNotFoundError:
+                pass
+        if removed:
+            print(f"[STORAGE] Удалено роликов: {len(removed)}, освобождено "
+                  f"{sum(c[1] for c in removed) / (1024 * 1024):.1f} МБ")
+        return len(removed)
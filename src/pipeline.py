@@ -0,0 +1,237 @@
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from src.blinks_analysis import analyze_ear_sequence, extract_ear_sequence, select_ear, threshold_from_ear
+from src.ear_cache import file_digest
+from src.ear_calibration import check_open_clip
+from src.instrumentation import current_context, ingest, request_context, stage
+from src.landmark_engine import get_landmark_engine
+from src.media import open_media
+from src.sound_analysis import (ANALYSIS_SR, BandpassStream, analyze_audio_signal, apply_vad, bandpass_filter,
+                                compute_spectral_features, load_audio_from_video)
+
+
+# Где считается голосовая ветка: parallel — в отдельном процессе на соседнем
+# ядре (два ffmpeg на ролик), serial — одним проходом ffmpeg вместе с кадрами.
+# auto выбирает parallel, только если у каждого воркера очереди
+# (ANALYSIS_WORKERS) есть свободное ядро под голосовой процесс.
+VOICE_BRANCH = os.getenv("VOICE_BRANCH", "auto")
+
+_voice_worker = None
+
+
+def voice_parallel():
+    if VOICE_BRANCH == "auto":
+        workers = int(os.getenv("ANALYSIS_WORKERS", "2"))
+        return 2 * workers <= (os.cpu_count() or 1)
+    return VOICE_BRANCH == "parallel"
+
+
+def warm_up_audio(sr=ANALYSIS_SR):
+    t = np.arange(sr) / sr
+    y = (0.1 * np.sin(2 * np.pi * 150 * t)).astype(np.float32)
+    y = apply_vad(bandpass_filter(y, sr), sr)
+    compute_spectral_features(y, sr)
+
+
+def warm_up(sr=ANALYSIS_SR):
+    # Прогрев воркера до первой задачи: граф FaceMesh и JIT-функции librosa
+    get_landmark_engine().process(np.zeros((64, 64, 3), dtype=np.uint8))
+    warm_up_audio(sr)
+
+
+def _voice_worker_loop(conn):
+    warm_up_audio()
+    while True:
+        try:
+            args = conn.recv()
+        except EOFError:
+            # Родительский процесс закрыл канал
+            return
+        try:
+            conn.send((True, voice_branch(*args)))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class VoiceWorker:
+    # Отдельный процесс под голосовую ветку, чтобы она шла на другом ядре
+    # параллельно с FaceMesh. Процесс свой, а не пул: брошенную на середине
+    # задачу (таймаут, ошибка видеоветки) останавливает terminate(), а
+    # упавший процесс не вешает ожидание результата.
+    def __init__(self):
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_voice_worker_loop, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.busy = False
+
+    def submit(self, *args):
+        self._conn.send(args)
+        self.busy = True
+
+    def result(self):
+        wait([self._conn, self.process.sentinel])
+        try:
+            ok, value = self._conn.recv()
+        except (EOFError, OSError):
+            # Процесс упал (segfault, OOM), не ответив
+            self.process.join()
+            raise RuntimeError(f"Процесс голосовой ветки завершился с кодом {self.process.exitcode}") from None
+        self.busy = False
+        if not ok:
+            raise value
+        return value
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join()
+        self._conn.close()
+
+
+def _get_voice_worker():
+    # Создаётся один раз на процесс-воркер и заново, если процесс умер
+    global _voice_worker
+    if _voice_worker is None or not _voice_worker.process.is_alive():
+        _voice_worker = VoiceWorker()
+    return _voice_worker
+
+
+def _reset_voice_worker():
+    # Голосовая задача, брошенная на середине, заняла бы процесс и задержала
+    # следующую задачу этого воркера, поэтому процесс завершается
+    global _voice_worker
+    worker, _voice_worker = _voice_worker, None
+    if worker is not None:
+        worker.terminate()
+
+
+def voice_branch(video_path, sr_target=ANALYSIS_SR, context=None):
+    start = time.perf_counter()
+    with request_context(**(context or {})) as ctx:
+        with stage('ffmpeg'):
+            y, sr = load_audio_from_video(video_path, sr_target, prefilter=True)
+        features = analyze_audio_signal(y, sr, prefiltered=True)
+    return features, time.perf_counter() - start, ctx['records']
+
+
+def ingest_clip(video_path, sr_target=ANALYSIS_SR, cache=None):
+    # EAR-ряд уже посчитан — FaceMesh не нужен, ffmpeg декодирует только звук.
+    # PCM проходит полосовой фильтр кусками прямо при чтении.
+    cached = cache.load(video_path) if cache is not None else None
+    audio_filter = BandpassStream(sr_target)
+    if cached is not None:
+        ear_values, fps, _ = cached
+        with open_media(video_path, sr_target=sr_target, video=False, audio_filter=audio_filter) as media, stage('ffmpeg'):
+            y, sr = media.audio()
+        audio_filter.record()
+        return ear_values, fps, y, sr
+
+    # Один проход ffmpeg: кадры уходят в FaceMesh, PCM копится параллельно
+    with open_media(video_path, sr_target=sr_target, audio_filter=audio_filter) as media:
+        ear_values, fps = extract_ear_sequence(media, cache, eye=None)
+        with stage('ffmpeg'):
+            y, sr = media.audio()
+    audio_filter.record()
+    return ear_values, fps, y, sr
+
+
+def run_branches(video_path, cache=None, sr_target=ANALYSIS_SR, parallel=None):
+    # Возвращает EAR-ряд обоих глаз (N, 2), fps, голосовые признаки и время по веткам.
+    # В параллельном режиме каждая ветка декодирует только свой поток
+    # (ffmpeg -vn не трогает видео), в последовательном — один общий проход.
+    # parallel=None — режим из VOICE_BRANCH
+    start = time.perf_counter()
+    if parallel is None:
+        parallel = voice_parallel()
+    if parallel:
+        voice = _get_voice_worker()
+        voice.submit(video_path, sr_target, current_context())
+        try:
+            ear_values, fps = extract_ear_sequence(video_path, cache, eye=None)
+            video_time = time.perf_counter() - start
+            features, audio_time, records = voice.result()
+        except BaseException:
+            # JobTimeout из очереди, ошибка видеоветки или упавший голосовой процесс
+            if voice.busy:
+                _reset_voice_worker()
+            raise
+        ingest(records)
+    else:
+        ear_values, fps, y, sr = ingest_clip(video_path, sr_target, cache)
+        video_time = time.perf_counter() - start
+        audio_start = time.perf_counter()
+        features = analyze_audio_signal(y, sr, prefiltered=True)
+        audio_time = time.perf_counter() - audio_start
+
+    timings = {
+        'video': video_time,
+        'audio': audio_time,
+        'total': time.perf_counter() - start,
+    }
+    print(f"[TIMING] video={timings['video']:.2f}s audio={timings['audio']:.2f}s total={timings['total']:.2f}s")
+    return ear_values, fps, features, timings
+
+
+def validate_open_clip(video_path, cache=None):
+    # Проверка первого калибровочного ролика сразу после загрузки. EAR-ряд
+    # попадает в кэш и не пересчитывается на финальном этапе калибровки.
+    ear_open, fps = extract_ear_sequence(video_path, cache, eye=None)
+    return {**check_open_clip(ear_open), 'FPS': fps}
+
+
+def calibrate_clip(open_video, blink_video, cache=None):
+    # Ролик с морганиями декодируется одним проходом ffmpeg, как в ingest_clip.
+    # Порог подбирается по кадрам до аудиоанализа: если он не подбирается,
+    # ролик отклоняется (CalibrationRejected), ffmpeg останавливается при
+    # выходе из блока, а STFT и Praat не запускаются.
+    start = time.perf_counter()
+    ear_open, _ = extract_ear_sequence(open_video, cache, eye=None)
+    audio_filter = BandpassStream(ANALYSIS_SR)
+    with open_media(blink_video, sr_target=ANALYSIS_SR, audio_filter=audio_filter) as media:
+        ear_blink, fps = extract_ear_sequence(media, cache, eye=None)
+        fit = threshold_from_ear(ear_open, ear_blink)
+        video_time = time.perf_counter() - start
+        with stage('ffmpeg'):
+            y, sr = media.audio()
+    audio_filter.record()
+    features = analyze_audio_signal(y, sr, prefiltered=True)
+
+    ear_threshold = fit['threshold']
+    blink_count, blink_rate, avg_dur = analyze_ear_sequence(select_ear(ear_blink, fit['eye']), ear_threshold, fps)
+
+    total = time.perf_counter() - start
+    return {
+        'EAR_THRESHOLD': ear_threshold,
+        'EAR_EYE': fit['eye'],
+        'EAR_CONFIDENCE': fit['confidence'],
+        'blink_rate': blink_rate,
+        'avg_dur': avg_dur,
+        'FPS': fps,
+        **features,
+        'timings': {'video': video_time, 'audio': total - video_time, 'total': total}
+    }
+
+
+def analyze_clip(video_path, ear_threshold, fps, cache=None, parallel=None, eye='both', feature_store=None):
+    ear_values, clip_fps, features, timings = run_branches(video_path, cache, parallel=parallel)
+    if feature_store is not None:
+        # Признаки ролика сохраняются отдельно от MP4: после его удаления
+        # пакетный пересчёт (batch.py) берёт их из хранилища
+        digest = cache.digest(video_path) if cache is not None else file_digest(video_path)
+        feature_store.store(digest, ear_values, clip_fps, features)
+
+    blink_count, blink_rate, avg_dur = analyze_ear_sequence(select_ear(ear_values, eye), ear_threshold, fps)
+
+    return {
+        'blink_rate': blink_rate,
+        'avg_dur': avg_dur,
+        'FPS': fps,
+        **features,
+        'timings': timings
+    }
@@ -0,0 +1,40 @@
+# Графики для ручной отладки калибровки и аудиопризнаков. matplotlib нужен
+# только здесь, модули анализа его не импортируют.
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+def plot_ear_histogram(ear_open, ear_blink, threshold):
+    plt.figure(figsize=(8,4))
+    plt.hist(ear_open, bins=50, alpha=0.6, label='Open')
+    plt.hist(ear_blink, bins=50, alpha=0.6, label='Blink')
+    plt.axvline(threshold, color='red', linestyle='--', label=f'TH={threshold:.3f}')
+    plt.legend()
+    plt.title('Калибровка порога EAR')
+    plt.xlabel('EAR')
+    plt.ylabel('Частота')
+    plt.show()
+
+
+def plot_audio_features(cent, flux, sr, rms_db):
+    hop_length = 512
+    times = np.arange(len(cent)) * hop_length / sr
+
+    plt.figure(figsize=(10, 6))
+    plt.subplot(3, 1, 1)
+    plt.plot(times, cent, label='Centroid')
+    plt.xlabel('Время (с)')
+    plt.ylabel('Частота (Гц)')
+    plt.legend()
+    plt.title('Spectral Centroid')
+    plt.subplot(3, 1, 2)
+    plt.plot(times, flux, label='Flux')
+    plt.legend()
+    plt.subplot(3, 1, 3)
+    plt.plot(times, rms_db, label='RMS dB')
+    plt.legend()
+    plt.title('Loudness')
+    plt.tight_layout()
+    plt.show()
+
+    return
@@ -1,103 +1,235 @@
 import os
+import time
+from functools import lru_cache
+
 import numpy as np
 import librosa
 import scipy.signal as sps
 import parselmouth
 from parselmouth.praat import call
-import speech_recognition as sr_module
-import subprocess
-import soundfile as sf
-import matplotlib.pyplot as plt
-
-def load_audio_from_video(video_path, sr_target=22050):
-    if not os.path.exists(video_path):
-        raise FileNotFoundError(f"Видео-файл не найден: {video_path}")
-
-    wav_path = "temp_audio.wav"
-    cmd = [
-        "ffmpeg",
-        "-y",
-        "-i", video_path,
-        "-vn",
-        "-ac", "1",
-        "-ar", str(sr_target),
-        "-f", "wav",
-        wav_path
-    ]
-
-    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        raise RuntimeError(f"FFmpeg error:\n{result.stderr.decode('utf-8')}")
-
-    y, sr = librosa.load(wav_path, sr=sr_target)
-    os.remove(wav_path)
-    return y, sr
+
+from src.instrumentation import record_stage, stage
+from src.media import open_media
+
+# Частота анализа звука. AUDIO_SR=16000 вдвое удешевляет все стадии после
+# декодирования (ffmpeg сразу отдаёт 16 кГц), но меняет спектральные признаки —
+# после переключения пользователям нужна новая калибровка.
+ANALYSIS_SR = int(os.getenv("AUDIO_SR", "22050"))
+
+@lru_cache(maxsize=None)
+def bandpass_sos(sr, low=80, high=8000, order=4):
+    # Фильтр в виде SOS считается один раз на частоту дискретизации. Верхний
+    # край держится не выше 0.9 от частоты Найквиста (при 16 кГц 8000 Гц совпал бы с ней)
+    high = min(high, 0.45 * sr)
+    return sps.butter(order, [low, high], btype='band', fs=sr, output='sos')
 
 def bandpass_filter(y, sr, low=80, high=8000, order=4):
-    nyq = sr / 2
-    b, a = sps.butter(order, [low/nyq, high/nyq], btype='band')
-    return sps.filtfilt(b, a, y)
+    # Один каузальный проход sosfilt вместо filtfilt по b/a
+    return sps.sosfilt(bandpass_sos(sr, low, high, order), y).astype(np.float32)
+
+class BandpassStream:
+    # Тот же фильтр по кускам сигнала: состояние переносится между кусками,
+    # поэтому результат совпадает с bandpass_filter по всему сигналу.
+    # Фильтр работает в потоке чтения ffmpeg, поэтому время набирается по
+    # кускам и записывается стадией bandpass через record()
+    def __init__(self, sr, low=80, high=8000, order=4):
+        self.sos = bandpass_sos(sr, low, high, order)
+        self.zi = np.zeros((self.sos.shape[0], 2))
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+
+    def __call__(self, chunk):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        y, self.zi = sps.sosfilt(self.sos, chunk, zi=self.zi)
+        y = y.astype(np.float32)
+        self.seconds += time.perf_counter() - wall
+        self.cpu_seconds += time.thread_time() - cpu
+        return y
+
+    def record(self):
+        record_stage('bandpass', self.seconds, self.cpu_seconds)
+
+def load_audio_from_video(video_path, sr_target=ANALYSIS_SR, prefilter=False):
+    # ffmpeg отдаёт PCM float32 через pipe сразу с нужной частотой —
+    # без временного wav и повторного чтения через librosa.
+    # prefilter=True — полосовой фильтр применяется кусками прямо при чтении
+    audio_filter = BandpassStream(sr_target) if prefilter else None
+    with open_media(video_path, sr_target=sr_target, video=False, audio_filter=audio_filter) as media:
+        y, sr = media.audio()
+    if audio_filter is not None:
+        audio_filter.record()
+    return y, sr
 
-def apply_vad(y, sr, top_db=30):
+class NoSpeechError(ValueError):
+    pass
+
+def apply_vad(y, sr, top_db=30, return_intervals=False):
     intervals = librosa.effects.split(y, top_db=top_db)
-    return np.concatenate([y[start:end] for start, end in intervals])
+    if len(intervals) == 0:
+        raise NoSpeechError("В аудио не найдено участков речи")
+    voiced = np.concatenate([y[start:end] for start, end in intervals])
+    if return_intervals:
+        return voiced, intervals
+    return voiced
 
 
 def compute_spectral_features(y, sr, frame_length=2048, hop_length=512):
-    centroids = librosa.feature.spectral_centroid(y=y, sr=sr,
-                                                  n_fft=frame_length,
-                                                  hop_length=hop_length)[0]
-    S = np.abs(librosa.stft(y, n_fft=frame_length, hop_length=hop_length))
-    S_norm = S / np.sum(S, axis=0, keepdims=True)
+    # Один амплитудный спектр float32 на центроид и спектральный поток
+    S = np.abs(librosa.stft(np.asarray(y, dtype=np.float32), n_fft=frame_length, hop_length=hop_length))
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=frame_length).astype(np.float32)
+
+    # Тихие кадры дают нулевую сумму — не делим на ноль
+    total = np.maximum(np.sum(S, axis=0), np.finfo(np.float32).tiny)
+    centroids = (freqs @ S) / total
+
+    S_norm = S / total
     flux = np.sqrt(np.sum((np.diff(S_norm, axis=1))**2, axis=0))
     flux = np.concatenate([[0], flux])
-    return centroids, flux
 
-def compute_rms_db(y, frame_length=2048, hop_length=512):
+    # RMS — по временным кадрам, как раньше: через спектр (окно Ханна) среднее
+    # уходит на 2 дБ и калибровки становятся несравнимы
     rms = librosa.feature.rms(y=y, frame_length=frame_length, hop_length=hop_length)[0]
     rms_db = librosa.amplitude_to_db(rms, ref=np.max)
-    return rms_db
-
-def compute_pitch_jitter_shimmer(y, sr):
-    snd = parselmouth.Sound(y, sampling_frequency=sr)
-    pitch = snd.to_pitch()
-    f0_values = pitch.selected_array['frequency']
-    f0_values = f0_values[f0_values > 0]
+    return centroids, flux, rms_db
+
+def compute_pitch_jitter_shimmer(y, sr, intervals=None, pitch_floor=75, pitch_ceiling=500, min_segment_sec=0.1):
+    # Один проход Praat на сегмент: трек высоты тона считается один раз
+    # (автокорреляция — в несколько раз быстрее cc при том же jitter), и из
+    # него же строится PointProcess — "To PointProcess (periodic, cc)"
+    # отслеживал бы высоту тона заново. Сегменты VAD (intervals) обрабатываются
+    # по отдельности, без склейки, чтобы стыки не давали ложных скачков
+    # jitter. Jitter и shimmer сегментов усредняются с весом по числу периодов.
+    y = np.asarray(y, dtype=np.float32)
+    if intervals is None:
+        intervals = [(0, len(y))]
+    min_len = int(min_segment_sec * sr)
+
+    f0_values = []
+    jitters, shimmers, weights = [], [], []
+    for start, end in intervals:
+        if end - start < min_len:
+            continue
+        snd = parselmouth.Sound(y[start:end], sampling_frequency=sr)
+        pitch = snd.to_pitch_ac(pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling)
+        f0 = pitch.selected_array['frequency']
+        f0_values.append(f0[f0 > 0])
+
+        point_process = call([snd, pitch], "To PointProcess (cc)")
+        periods = call(point_process, "Get number of periods", 0, 0, 0.0001, 0.02, 1.3)
+        jitter = call(point_process, "Get jitter (local)", 0, 0, 0.0001, 0.02, 1.3)  # %
+        shimmer = call([snd, point_process], "Get shimmer (local)", 0, 0, 0.0001, 0.02, 1.3, 1.6)  # dB
+        if periods > 0 and not np.isnan(jitter) and not np.isnan(shimmer):
+            jitters.append(jitter)
+            shimmers.append(shimmer)
+            weights.append(periods)
+
+    f0_values = np.concatenate(f0_values) if f0_values else np.zeros(0)
     f0_mean = np.mean(f0_values) if len(f0_values) else 0
-
-    point_process = call(snd, "To PointProcess (periodic, cc)", 75, 500)
-    jitter_local = call(point_process, "Get jitter (local)", 0, 0, 0.0001, 0.02, 1.3)  # %
-    shimmer_local = call([snd, point_process], "Get shimmer (local)", 0, 0, 0.0001, 0.02, 1.3, 1.6)  # dB
+    if not weights:
+        return f0_mean, float('nan'), float('nan')
+    jitter_local = np.average(jitters, weights=weights)
+    shimmer_local = np.average(shimmers, weights=weights)
 
     return f0_mean, jitter_local, shimmer_local
 
-def compute_speech_rate(y, sr, language):
-    wav = "temp_sr.wav"
-    sf.write(wav, y, sr)
+# Среднее число слогов в слове для русской речи: переводит слоги/мин в слова/мин
+SYLLABLES_PER_WORD = 2.3
+
+
+def estimate_speech_rate(y, sr, intervals=None, frame_sec=0.025, hop_sec=0.010,
+                         min_prominence_db=2.0, min_gap_sec=0.1, max_zcr=0.15):
+    # Локальная оценка темпа по ядрам слогов: пики огибающей энергии,
+    # выделяющиеся над соседними провалами, на вокализованных (низкий ZCR)
+    # участках речи. Паузы между интервалами VAD входят в длительность.
+    y = np.asarray(y, dtype=np.float64)
+    frame = max(1, int(frame_sec * sr))
+    hop = max(1, int(hop_sec * sr))
+    if len(y) < frame:
+        return 0.0
+
+    starts = np.arange(0, len(y) - frame + 1, hop)
+    energy_cum = np.concatenate([[0.0], np.cumsum(y ** 2)])
+    energy = (energy_cum[starts + frame] - energy_cum[starts]) / frame
+    env_db = 10 * np.log10(energy + 1e-10)
+    env_db = np.convolve(env_db, np.ones(5) / 5, mode='same')
+
+    signs = np.signbit(y)
+    cross_cum = np.concatenate([[0], np.cumsum(signs[1:] != signs[:-1])])
+    zcr = (cross_cum[starts + frame - 1] - cross_cum[starts]) / frame
+
+    peaks, _ = sps.find_peaks(
+        env_db,
+        height=np.median(env_db),
+        prominence=min_prominence_db,
+        distance=max(1, int(min_gap_sec / hop_sec)),
+    )
+    peaks = peaks[zcr[peaks] < max_zcr]
+
+    if intervals is not None and len(intervals):
+        intervals = np.asarray(intervals)
+        centers = starts[peaks] + frame // 2
+        idx = np.searchsorted(intervals[:, 0], centers, side='right') - 1
+        inside = (idx >= 0) & (centers < intervals[np.maximum(idx, 0), 1])
+        peaks = peaks[inside]
+        speech_sec = (intervals[-1, 1] - intervals[0, 0]) / sr
+    else:
+        speech_sec = len(y) / sr
+
+    if speech_sec <= 0:
+        return 0.0
+    syllables_per_min = len(peaks) / speech_sec * 60.0
+    return syllables_per_min / SYLLABLES_PER_WORD
+
+
+def recognize_speech_rate(y, sr, language, intervals=None):
+    # Импорт по требованию: распознавание через сеть нужно только для backend="google"
+    import speech_recognition as sr_module
+
+    pcm = (np.clip(y, -1.0, 1.0) * 32767).astype(np.int16)
+    audio = sr_module.AudioData(pcm.tobytes(), sr, 2)
 
     recognizer = sr_module.Recognizer()
-    with sr_module.AudioFile(wav) as source:
-        audio = recognizer.record(source)
     try:
         text = recognizer.recognize_google(audio, language=language)
     except Exception:
         text = ""
-    os.remove(wav)
 
     words = len(text.split())
-    duration_min = len(y) / sr / 60.0
+    if intervals is not None and len(intervals):
+        duration_min = (intervals[-1][1] - intervals[0][0]) / sr / 60.0
+    else:
+        duration_min = len(y) / sr / 60.0
     wpm = words / duration_min if duration_min > 0 else 0.0
     return wpm
 
-def analyze_audio(video_file):
-    y, sr = load_audio_from_video(video_file)
-    y = bandpass_filter(y, sr)
-    y = apply_vad(y, sr)
 
-    centroids, flux = compute_spectral_features(y, sr)
-    rms_db = compute_rms_db(y)
-    f0_mean, jitter_local, shimmer_local = compute_pitch_jitter_shimmer(y, sr)
-    wpm = compute_speech_rate(y, sr, language="ru-RU")
+def compute_speech_rate(y, sr, language, intervals=None, backend="local"):
+    # backend="google" — распознавание через сеть, медленно и требует доступа в интернет
+    if backend == "google":
+        return recognize_speech_rate(y, sr, language, intervals)
+    if backend != "local":
+        raise ValueError(f"Неизвестный способ оценки темпа речи: {backend}")
+    return estimate_speech_rate(y, sr, intervals)
+
+def analyze_audio(video_file, speech_rate_backend="local"):
+    y, sr = load_audio_from_video(video_file, prefilter=True)
+    return analyze_audio_signal(y, sr, speech_rate_backend, prefiltered=True)
+
+def analyze_audio_signal(y, sr, speech_rate_backend="local", prefiltered=False):
+    # prefiltered=True — сигнал уже прошёл bandpass_filter/BandpassStream
+    if not prefiltered:
+        with stage('bandpass'):
+            y = bandpass_filter(y, sr)
+    with stage('vad'):
+        y_voiced, intervals = apply_vad(y, sr, return_intervals=True)
+
+    with stage('stft'):
+        centroids, flux, rms_db = compute_spectral_features(y_voiced, sr)
+    with stage('praat'):
+        f0_mean, jitter_local, shimmer_local = compute_pitch_jitter_shimmer(y, sr, intervals)
+    with stage('speech_rate'):
+        wpm = compute_speech_rate(y, sr, language="ru-RU", intervals=intervals, backend=speech_rate_backend)
 
     features = {
         'spectral_centroid_mean': float(np.mean(centroids)),
@@ -109,33 +241,10 @@ def analyze_audio(video_file):
         'speech_rate_wpm': float(wpm)
     }
 
-    # plot(centroids, flux, sr, rms_db)
+    # from src.plotting import plot_audio_features; plot_audio_features(centroids, flux, sr, rms_db)
 
     return features
 
-def plot(cent, flux, sr, rms_db):
-    hop_length = 512
-    times = np.arange(len(cent)) * hop_length / sr
-
-    plt.figure(figsize=(10, 6))
-    plt.subplot(3, 1, 1)
-    plt.plot(times, cent, label='Centroid')
-    plt.xlabel('Время (с)')
-    plt.ylabel('Частота (Гц)')
-    plt.legend()
-    plt.title('Spectral Centroid')
-    plt.subplot(3, 1, 2)
-    plt.plot(times, flux, label='Flux')
-    plt.legend()
-    plt.subplot(3, 1, 3)
-    plt.plot(times, rms_db, label='RMS dB')
-    plt.legend()
-    plt.title('Loudness')
-    plt.tight_layout()
-    plt.show()
-
-    return
-
 if __name__ == '__main__':
     video = '/Users/admin/ITMO/Projects/Neurotechnology and biometrics/src/videos/407154220/20250625_052140.mp4'
     feats = analyze_audio(video)
@@ -0,0 +1,90 @@
+import math
+from collections import deque
+
+import numpy as np
+
+from src.blink_detector import BlinkDetector
+from src.blinks_analysis import compute_ear_batch, iter_eye_points, select_ear
+from src.fatigue_calc import calculate_fatigue, fatigue_to_absolute_kss
+from src.media import iter_audio_chunks, open_media
+from src.sound_analysis import ANALYSIS_SR, BandpassStream, NoSpeechError, analyze_audio_signal
+
+VOICE_FEATURES = [
+    'spectral_centroid_mean',
+    'spectral_flux_mean',
+    'rms_db_mean',
+    'f0_mean_hz',
+    'jitter_percent',
+    'shimmer_db',
+    'speech_rate_wpm',
+]
+
+
+def _voice_window(chunks, sr, calibration):
+    # Окно без речи не даёт информации о голосе — берём значения калибровки,
+    # чтобы вклад голосовых признаков в усталость был нулевым
+    try:
+        return analyze_audio_signal(np.concatenate(chunks), sr, prefiltered=True), True
+    except NoSpeechError:
+        return {k: calibration[k] for k in VOICE_FEATURES}, False
+
+
+def analyze_stream(video_path, calibration, window_sec=30.0, hop_sec=10.0, consec_frames=2, sr_target=ANALYSIS_SR):
+    # Скользящее окно по длинной записи: каждые hop_sec секунд выдаёт признаки
+    # и оценку KSS за последние window_sec секунд. В памяти только звук одного
+    # окна и события морганий внутри него.
+    ear_threshold = calibration['EAR_THRESHOLD']
+    eye = calibration.get('EAR_EYE', 'both')
+    hops_per_window = max(1, math.ceil(window_sec / hop_sec))
+    audio_window = deque(maxlen=hops_per_window)
+    detector = BlinkDetector(ear_threshold, consec_frames, rate_window_sec=window_sec)
+
+    with open_media(video_path, audio=False) as media:
+        fps = media.fps
+        hop_frames = max(1, round(hop_sec * fps))
+        audio_chunks = iter_audio_chunks(video_path, sr_target, hop_sec)
+        # Каждый кусок фильтруется один раз при поступлении, а не заново в каждом окне
+        bandpass = BandpassStream(sr_target)
+
+        frame_idx = 0
+
+        def emit():
+            t_end = frame_idx / fps
+            chunk = next(audio_chunks, None)
+            if chunk is not None:
+                audio_window.append(bandpass(chunk))
+
+            current = {
+                'blink_rate': detector.blink_rate(t_end),
+                'avg_dur': detector.avg_duration(),
+            }
+            if audio_window:
+                voice, voiced = _voice_window(list(audio_window), sr_target, calibration)
+            else:
+                voice, voiced = {k: calibration[k] for k in VOICE_FEATURES}, False
+            current.update(voice)
+
+            fatigue = calculate_fatigue(calibration, current)
+            return {
+                't_start': max(0.0, t_end - window_sec),
+                't_end': t_end,
+                'blink_count': len(detector.events),
+                **current,
+                'voiced': voiced,
+                'fatigue': fatigue,
+                'kss': fatigue_to_absolute_kss(fatigue, calibration['KSS_baseline']),
+            }
+
+        try:
+            for pts in iter_eye_points(media):
+                detector.update(float(select_ear(compute_ear_batch(pts), eye)), frame_idx / fps)
+                frame_idx += 1
+                if frame_idx % hop_frames == 0:
+                    yield emit()
+
+            # Моргание, не закончившееся к концу записи, тоже входит в последнее окно
+            flushed = detector.flush(frame_idx / fps)
+            if frame_idx % hop_frames or flushed is not None:
+                yield emit()
+        finally:
+            audio_chunks.close()
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from src.blink_detector import BlinkDetector, segment_blinks
+
+FPS = 30.0
+THRESHOLD = 0.2
+
+
+def old_state_machine(ear_values, ear_threshold, fps, consec_frames=2, min_duration_ms=50):
+    # Покадровый подсчёт из исходного analyze_video: начало — на consec_frames-м
+    # закрытом кадре, без гистерезиса, незакончившееся моргание отбрасывается
+    consec = 0
+    blink_start = None
+    durations = []
+    for frame_idx, ear in enumerate(ear_values):
+        if ear < ear_threshold:
+            consec += 1
+            if consec == consec_frames:
+                blink_start = frame_idx
+        else:
+            if blink_start is not None:
+                duration_ms = (frame_idx - blink_start) * (1000.0 / fps)
+                if duration_ms > min_duration_ms:
+                    durations.append(duration_ms)
+            consec = 0
+            blink_start = None
+    return durations
+
+
+def detector_durations(ear_values, fps=FPS, **kwargs):
+    detector = BlinkDetector(THRESHOLD, rate_window_sec=1e9, **kwargs)
+    for i, ear in enumerate(ear_values):
+        detector.update(float(ear), i / fps)
+    detector.flush(len(ear_values) / fps)
+    return [d for _, d in detector.events]
+
+
+def series_with_blinks(blinks, n=100):
+    ear = np.full(n, 0.3)
+    for start, length in blinks:
+        ear[start:start + length] = 0.1
+    return ear
+
+
+@pytest.mark.parametrize("consec_frames", [1, 2, 3])
+def test_segment_blinks_matches_old_state_machine(consec_frames):
+    # Без гистерезиса и порога длительности отличие только в начале моргания:
+    # старый автомат начинал его на consec_frames - 1 кадров позже
+    rng = np.random.default_rng(consec_frames)
+    for _ in range(200):
+        ear = rng.choice([0.1, 0.3], size=rng.integers(1, 60), p=[0.4, 0.6])
+        # Открытый кадр в конце: незакрытые моргания старый автомат не считал
+        ear = np.append(ear, 0.3)
+        old = old_state_machine(ear, THRESHOLD, FPS, consec_frames, min_duration_ms=0)
+        _, _, new = segment_blinks(ear, THRESHOLD, FPS, consec_frames, min_duration_ms=0, hysteresis=0)
+        shift = (consec_frames - 1) * 1000.0 / FPS
+        np.testing.assert_allclose(new, np.array(old) + shift)
+
+
+def test_segment_blinks_counts_blink_open_at_end():
+    ear = series_with_blinks([(10, 2), (30, 3), (50, 5), (95, 5)])
+    starts, ends, durations = segment_blinks(ear, THRESHOLD, FPS)
+    np.testing.assert_array_equal(starts, [10, 30, 50, 95])
+    np.testing.assert_array_equal(ends, [12, 33, 55, 100])
+    np.testing.assert_allclose(durations, [66.67, 100.0, 166.67, 166.67], atol=0.01)
+
+
+def test_segment_blinks_hysteresis_and_missing_face():
+    # Кадр чуть выше порога (в пределах гистерезиса) и кадр без лица не разрывают моргание
+    ear = np.array([0.3, 0.1, 0.1, 0.205, np.nan, 0.1, 0.3, 0.3])
+    starts, ends, durations = segment_blinks(ear, THRESHOLD, FPS)
+    np.testing.assert_array_equal(starts, [1])
+    np.testing.assert_array_equal(ends, [6])
+
+
+def test_segment_blinks_empty():
+    starts, ends, durations = segment_blinks([], THRESHOLD, FPS)
+    assert len(starts) == len(ends) == len(durations) == 0
+
+
+def test_detector_matches_segment_blinks():
+    ear = series_with_blinks([(10, 2), (30, 3), (50, 5), (95, 5)])
+    np.testing.assert_allclose(detector_durations(ear), segment_blinks(ear, THRESHOLD, FPS)[2])
+
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        ear = rng.choice([0.1, 0.205, 0.3, np.nan], size=rng.integers(1, 80), p=[0.3, 0.1, 0.5, 0.1])
+        np.testing.assert_allclose(detector_durations(ear), segment_blinks(ear, THRESHOLD, FPS)[2])
+
+
+def test_detector_rate_window():
+    detector = BlinkDetector(THRESHOLD, consec_frames=1, rate_window_sec=10.0)
+    ear = series_with_blinks([(30 * k, 3) for k in range(1, 10)], n=300)
+    for i, value in enumerate(ear):
+        detector.update(float(value), i / FPS)
+    # Моргания каждую секунду: в окне 10 с — те, что закончились за последние 10 с
+    assert detector.blink_count == 9
+    assert detector.blink_rate(10.0) == pytest.approx(len(detector.events) / (10.0 / 60))
+    assert detector.avg_duration() == pytest.approx(100.0)
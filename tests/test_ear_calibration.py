@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from src.ear_calibration import MIN_CONFIDENCE, CalibrationRejected, check_open_clip, fit_threshold
+
+
+def open_clip(n=90, level=0.30, seed=0):
+    rng = np.random.default_rng(seed)
+    return level + 0.005 * rng.standard_normal(n)
+
+
+def blink_clip(n_open=80, n_closed=10, level=0.30, closed=0.08, seed=1):
+    rng = np.random.default_rng(seed)
+    values = np.concatenate([level + 0.005 * rng.standard_normal(n_open),
+                             closed + 0.005 * rng.standard_normal(n_closed)])
+    return rng.permutation(values)
+
+
+def test_fit_accepts_clear_blinks():
+    fit = fit_threshold(open_clip(), blink_clip())
+    assert 0.08 < fit['threshold'] < 0.30
+    assert fit['eye'] == 'both'
+    assert MIN_CONFIDENCE <= fit['confidence'] <= 1.0
+
+
+def test_fit_prefers_the_visible_eye():
+    # Правый глаз под бликом: его EAR на ролике с морганиями — только шум
+    ear_open = np.stack([open_clip(seed=0), open_clip(seed=2)], axis=1)
+    left = blink_clip(seed=3)
+    right = 0.30 + 0.04 * np.random.default_rng(4).standard_normal(len(left))
+    fit = fit_threshold(ear_open, np.stack([left, right], axis=1))
+    assert fit['eye'] == 'left'
+    assert fit['confidence'] > fit['eyes']['both']['confidence']
+
+
+def test_reject_open_clip_without_face():
+    ear = open_clip()
+    ear[::3] = np.nan
+    with pytest.raises(CalibrationRejected):
+        check_open_clip(ear)
+
+
+def test_reject_short_open_clip():
+    with pytest.raises(CalibrationRejected):
+        check_open_clip(open_clip(n=20))
+
+
+def test_reject_open_clip_with_closed_eyes():
+    ear = open_clip()
+    ear[:20] = 0.08
+    with pytest.raises(CalibrationRejected):
+        check_open_clip(ear)
+
+
+def test_reject_blink_clip_without_blinks():
+    with pytest.raises(CalibrationRejected):
+        fit_threshold(open_clip(), open_clip(seed=5))
+
+
+def test_reject_blink_clip_without_face():
+    ear = blink_clip()
+    ear[::2] = np.nan
+    with pytest.raises(CalibrationRejected):
+        fit_threshold(open_clip(), ear)
+
+
+def test_reject_low_confidence():
+    # «Закрытые» кадры едва ниже открытых, а открытые глаза во время речи сильно гуляют
+    rng = np.random.default_rng(6)
+    ear_blink = np.concatenate([np.tile([0.28, 0.46], 40), 0.27 - 0.02 * rng.random(10)])
+    with pytest.raises(CalibrationRejected):
+        fit_threshold(open_clip(), ear_blink)
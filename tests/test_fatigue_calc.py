@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from src.fatigue_calc import (FEATURE_VERSION, FEATURES, calculate_fatigue, calibration_outdated, fatigue_contributions, fatigue_scores,
+                              fatigue_to_absolute_kss, feature_matrix)
+
+BASELINE = {
+    'blink_rate': 18.0, 'avg_dur': 150.0, 'spectral_centroid_mean': 1500.0, 'spectral_flux_mean': 0.05,
+    'rms_db_mean': -20.0, 'f0_mean_hz': 130.0, 'jitter_percent': 0.01, 'shimmer_db': 0.3,
+    'speech_rate_wpm': 100.0,
+}
+
+
+def old_calculate_fatigue(calibration, current, skip=()):
+    # Исходный расчёт по словарю параметров
+    params = {
+        'blink_rate': {'weight': 0.15, 'direction': 1},
+        'avg_dur': {'weight': 0.20, 'direction': 1},
+        'spectral_centroid_mean': {'weight': 0.05, 'direction': -1},
+        'spectral_flux_mean': {'weight': 0.05, 'direction': 1},
+        'rms_db_mean': {'weight': 0.10, 'direction': -1},
+        'f0_mean_hz': {'weight': 0.10, 'direction': -1},
+        'jitter_percent': {'weight': 0.10, 'direction': 1},
+        'shimmer_db': {'weight': 0.10, 'direction': 1},
+        'speech_rate_wpm': {'weight': 0.15, 'direction': -1}
+    }
+    fatigue_score = 0
+    for param, info in params.items():
+        if param in skip:
+            continue
+        diff = current[param] - calibration[param]
+        fatigue_score += info['weight'] * (info['direction'] * diff) / abs(calibration[param])
+    return fatigue_score
+
+
+def old_fatigue_to_absolute_kss(fatigue_score, kss_baseline):
+    return round(min(max(1, kss_baseline + fatigue_score * 4), 9))
+
+
+def random_rows(n, seed=0):
+    rng = np.random.default_rng(seed)
+    base = np.array([BASELINE[f] for f in FEATURES])
+    calibrations = base * rng.uniform(0.5, 1.5, (n, len(FEATURES)))
+    currents = calibrations * rng.uniform(0.5, 1.5, calibrations.shape)
+    return ([dict(zip(FEATURES, row)) for row in calibrations],
+            [dict(zip(FEATURES, row)) for row in currents])
+
+
+def test_calculate_fatigue_matches_old():
+    calibrations, currents = random_rows(200)
+    for calibration, current in zip(calibrations, currents):
+        assert calculate_fatigue(calibration, current) == pytest.approx(old_calculate_fatigue(calibration, current))
+
+
+def test_fatigue_scores_matches_old_row_by_row():
+    calibrations, currents = random_rows(200, seed=1)
+    scores = fatigue_scores(feature_matrix(calibrations), feature_matrix(currents))
+    expected = [old_calculate_fatigue(c, x) for c, x in zip(calibrations, currents)]
+    np.testing.assert_allclose(scores, expected)
+
+    # Одна калибровка на все строки
+    scores = fatigue_scores(feature_matrix([BASELINE])[0], feature_matrix(currents))
+    np.testing.assert_allclose(scores, [old_calculate_fatigue(BASELINE, x) for x in currents])
+
+
+def test_zero_calibration_drops_feature():
+    # Старый расчёт падал с ZeroDivisionError; теперь признак просто не входит в оценку
+    calibration = dict(BASELINE, speech_rate_wpm=0.0)
+    current = {k: v * 1.2 for k, v in BASELINE.items()}
+    with pytest.raises(ZeroDivisionError):
+        old_calculate_fatigue(calibration, current)
+    expected = old_calculate_fatigue(calibration, current, skip=('speech_rate_wpm',))
+    assert calculate_fatigue(calibration, current) == pytest.approx(expected)
+    assert fatigue_contributions(calibration, current)['speech_rate_wpm'] == 0.0
+    assert np.isfinite(fatigue_scores(feature_matrix([calibration]), feature_matrix([current]))).all()
+
+
+def test_nan_feature_drops_out():
+    current = dict(BASELINE, f0_mean_hz=float('nan'))
+    assert calculate_fatigue(BASELINE, current) == 0.0
+
+
+def test_contributions_sum_to_score():
+    current = {k: v * 0.9 for k, v in BASELINE.items()}
+    assert sum(fatigue_contributions(BASELINE, current).values()) == pytest.approx(calculate_fatigue(BASELINE, current))
+
+
+def test_kss_matches_old_for_scalars_and_arrays():
+    scores = np.linspace(-3, 3, 121)
+    for baseline in (1, 5, 9):
+        expected = [old_fatigue_to_absolute_kss(s, baseline) for s in scores]
+        assert [fatigue_to_absolute_kss(s, baseline) for s in scores] == expected
+        np.testing.assert_array_equal(fatigue_to_absolute_kss(scores, baseline), expected)
+    assert isinstance(fatigue_to_absolute_kss(0.1, 5), int)
+
+
+def test_calibration_version():
+    # Калибровки без версии считались по старым определениям признаков
+    assert calibration_outdated(dict(BASELINE))
+    assert calibration_outdated(dict(BASELINE, FEATURE_VERSION=FEATURE_VERSION - 1))
+    assert not calibration_outdated(dict(BASELINE, FEATURE_VERSION=FEATURE_VERSION))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from src.media import average_fps, crop_i420, i420_to_rgb
+
+
+def make_frame(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, (height * 3 // 2, width), dtype=np.uint8)
+
+
+def planes(frame, width, height):
+    flat = frame.reshape(-1)
+    plane = width * height
+    return (flat[:plane].reshape(height, width),
+            flat[plane:plane + plane // 4].reshape(height // 2, width // 2),
+            flat[plane + plane // 4:].reshape(height // 2, width // 2))
+
+
+@pytest.mark.parametrize("box", [(0, 0, 64, 48), (10, 20, 50, 40), (2, 2, 4, 4), (0, 0, 320, 240)])
+def test_crop_i420_matches_planes(box):
+    width, height = 320, 240
+    frame = make_frame(width, height)
+    x0, y0, x1, y1 = box
+    out = crop_i420(frame, width, height, box)
+    assert out.shape == ((y1 - y0) * 3 // 2, x1 - x0)
+
+    y, u, v = planes(frame, width, height)
+    cy, cu, cv = planes(out, x1 - x0, y1 - y0)
+    np.testing.assert_array_equal(cy, y[y0:y1, x0:x1])
+    np.testing.assert_array_equal(cu, u[y0 // 2:y1 // 2, x0 // 2:x1 // 2])
+    np.testing.assert_array_equal(cv, v[y0 // 2:y1 // 2, x0 // 2:x1 // 2])
+
+
+def test_crop_i420_matches_rgb_crop():
+    # Вырезка до перевода в RGB даёт то же, что вырезка из RGB-кадра
+    width, height = 160, 120
+    frame = make_frame(width, height, seed=1)
+    x0, y0, x1, y1 = 24, 16, 96, 80
+    np.testing.assert_array_equal(i420_to_rgb(crop_i420(frame, width, height, (x0, y0, x1, y1))),
+                                  i420_to_rgb(frame)[y0:y1, x0:x1])
+
+
+def test_average_fps():
+    assert average_fps(np.arange(90) / 30.0, 25.0) == pytest.approx(30.0)
+    # Переменная частота: 30 кадров за первую секунду, 15 — за вторую
+    t = np.concatenate([np.arange(30) / 30.0, 1.0 + np.arange(16) / 15.0])
+    assert average_fps(t, 30.0) == pytest.approx(45 / 2.0)
+    assert average_fps(np.zeros(1), 25.0) == 25.0
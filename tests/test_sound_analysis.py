@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("librosa")
+pytest.importorskip("parselmouth")
+
+from src.sound_analysis import BandpassStream, bandpass_filter, bandpass_sos
+
+
+@pytest.mark.parametrize("sr", [16000, 22050])
+def test_stream_matches_whole_signal(sr):
+    rng = np.random.default_rng(0)
+    y = rng.standard_normal(3 * sr).astype(np.float32)
+    stream = BandpassStream(sr)
+    # Куски разной длины, как из pipe ffmpeg
+    bounds = np.cumsum(rng.integers(1, 8192, 64))
+    chunks = [stream(chunk) for chunk in np.split(y, bounds[bounds < len(y)])]
+    filtered = np.concatenate(chunks)
+    assert filtered.dtype == np.float32
+    np.testing.assert_allclose(filtered, bandpass_filter(y, sr), rtol=1e-5, atol=1e-6)
+    assert stream.seconds > 0
+
+
+def test_sos_is_cached_and_below_nyquist():
+    assert bandpass_sos(16000) is bandpass_sos(16000)
+    # Верхний край 8000 Гц при 16 кГц совпал бы с частотой Найквиста
+    y = np.sin(2 * np.pi * 1000 * np.arange(16000) / 16000).astype(np.float32)
+    assert np.isfinite(bandpass_filter(y, 16000)).all()